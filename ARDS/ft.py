@@ -71,8 +71,7 @@ if __name__ == "__main__":
   init_vectors = None
   if cfg.has_option('data', 'embed'):
     embed_file = os.path.join(base, cfg.get('data', 'embed'))
-    w2v = word2vec.Model(embed_file)
-    init_vectors = [w2v.select_vectors(dataset.token2int)]
+    init_vectors = [word2vec.load_vectors(embed_file, dataset.token2int)]
 
   classes = len(dataset.label2int)
   maxlen = max([len(seq) for seq in x])
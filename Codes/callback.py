@@ -1,19 +1,30 @@
 from keras.callbacks import Callback
+import batches
 from sklearn.metrics import f1_score
 from sklearn.metrics import precision_score
 from sklearn.metrics import recall_score
 
 class Metrics(Callback):
 
+  def __init__(self, valid_batches=None):
+    """Score valid_batches (PaddedBatches without shuffling,
+    e.g. bucketed) or else the validation data given to fit()"""
+
+    super().__init__()
+    self.valid_batches = valid_batches
+
   def on_epoch_end(self, epoch, logs={}):
     """Compute f1 score"""
 
-    # this is what we passed to fit()
-    valid_x = self.validation_data[0]
-    valid_y = self.validation_data[1]
-
     # probability for each class (test size, num of classes)
-    distribution = self.model.predict(valid_x)
+    if self.valid_batches != None:
+      valid_y = self.valid_batches.y
+      distribution = batches.predict(self.model, self.valid_batches)
+    else:
+      # this is what we passed to fit()
+      valid_x = self.validation_data[0]
+      valid_y = self.validation_data[1]
+      distribution = self.model.predict(valid_x)
 
     # turn into an indicator matrix
     distribution[distribution < 0.5] = 0
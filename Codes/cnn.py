@@ -26,13 +26,12 @@ from sklearn.model_selection import train_test_split
 import keras as k
 from keras.utils.np_utils import to_categorical
 from keras.optimizers import RMSprop
-from keras.preprocessing.sequence import pad_sequences
 from keras.models import Sequential
 from keras.layers.core import Dense, Activation, Dropout
 from keras.layers import Conv1D, GlobalMaxPooling1D
 from keras.layers.embeddings import Embedding
 from keras.models import load_model
-import dataset, word2vec, callback
+import dataset, word2vec, callback, batches
 
 # ignore sklearn warnings
 def warn(*args, **kwargs):
@@ -59,6 +58,8 @@ def print_config(cfg):
   print('activation:', cfg.get('cnn', 'activation'))
   print('filters:', cfg.get('cnn', 'filters'))
   print('filtlen:', cfg.get('cnn', 'filtlen'))
+  if cfg.has_option('cnn', 'bucket'):
+    print('bucket:', cfg.get('cnn', 'bucket'))
   if cfg.has_option('data', 'embed'):
     print('embeddings:', cfg.get('data', 'embed'))
   if cfg.has_option('cnn', 'optimizer'):
@@ -72,7 +73,7 @@ def get_model(cfg, init_vectors, num_of_features):
   model = Sequential()
   model.add(Embedding(input_dim=num_of_features,
                       output_dim=cfg.getint('cnn', 'embdims'),
-                      input_length=maxlen,
+                      input_length=None if bucket else maxlen,
                       trainable=True,
                       weights=init_vectors,
                       name='EL'))
@@ -112,27 +113,40 @@ if __name__ == "__main__":
     cfg.getint('args', 'max_tokens_in_file'),
     cfg.getint('args', 'min_examples_per_code'),
     use_cuis=False)
-  x, y = dataset.load(tokens_as_set=False)
-  train_x, val_x, train_y, val_y = train_test_split(
-    x,
-    y,
+  x, y = dataset.load(tokens_as_set=False, as_ragged=True, sparse_codes=True)
+  train_idx, val_idx = train_test_split(
+    np.arange(len(x)),
     test_size=cfg.getfloat('args', 'test_size'))
-  maxlen = max([len(seq) for seq in train_x])
+  train_x, val_x = x[train_idx], x[val_idx]
+  train_y, val_y = y[train_idx], y[val_idx]
+  maxlen = int(train_x.lengths().max())
+
+  # batches of similar length padded to their own max length
+  bucket = cfg.has_option('cnn', 'bucket') and cfg.getboolean('cnn', 'bucket')
 
   init_vectors = None
   if cfg.has_option('data', 'embed'):
     embed_file = os.path.join(base, cfg.get('data', 'embed'))
-    w2v = word2vec.Model(embed_file)
-    init_vectors = [w2v.select_vectors(dataset.token2int)]
+    init_vectors = [word2vec.load_vectors(embed_file, dataset.token2int)]
 
-  # turn x into numpy array among other things
+  # training batches are padded and densified on the fly
   classes = len(dataset.code2int)
-  train_x = pad_sequences(train_x, maxlen=maxlen)
-  val_x = pad_sequences(val_x, maxlen=maxlen)
-  train_y = np.array(train_y)
-  val_y = np.array(val_y)
-
-  print('train_x shape:', train_x.shape)
+  val_y = val_y.toarray()
+
+  # bucketed validation is padded the same way as training
+  val_batches = None
+  if bucket:
+    val_batches = batches.PaddedBatches(
+      val_x,
+      val_y,
+      cfg.getint('cnn', 'batch'),
+      maxlen,
+      shuffle=False,
+      min_len=cfg.getint('cnn', 'filtlen'),
+      bucket=True)
+  val_x = val_x.pad(maxlen)
+
+  print('train_x examples:', len(train_x))
   print('train_y shape:', train_y.shape)
   print('val_x shape:', val_x.shape)
   print('val_y shape:', val_y.shape)
@@ -148,13 +162,18 @@ if __name__ == "__main__":
   model.compile(loss='binary_crossentropy',
                 optimizer=optimizer,
                 metrics=['accuracy'])
-  model.fit(train_x,
-            train_y,
-            callbacks=[callback.Metrics()] if val_x.shape[0]>0 else None,
-            validation_data=(val_x, val_y) if val_x.shape[0]>0 else None,
-            epochs=cfg.getint('cnn', 'epochs'),
-            batch_size=cfg.getint('cnn', 'batch'),
-            validation_split=0.0)
+  train_batches = batches.PaddedBatches(
+    train_x,
+    train_y,
+    cfg.getint('cnn', 'batch'),
+    maxlen,
+    bucket=bucket,
+    min_len=cfg.getint('cnn', 'filtlen'))
+  validation_data = (val_x, val_y) if val_batches == None else val_batches
+  model.fit_generator(train_batches,
+                      callbacks=[callback.Metrics(val_batches)] if val_x.shape[0]>0 else None,
+                      validation_data=validation_data if val_x.shape[0]>0 else None,
+                      epochs=cfg.getint('cnn', 'epochs'))
 
   model.save(MODEL_FILE)
 
@@ -163,7 +182,10 @@ if __name__ == "__main__":
     exit()
 
   # probability for each class; (test size, num of classes)
-  distribution = model.predict(val_x)
+  if val_batches != None:
+    distribution = batches.predict(model, val_batches)
+  else:
+    distribution = model.predict(val_x)
 
   # turn into an indicator matrix
   distribution[distribution < 0.5] = 0
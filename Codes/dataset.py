@@ -2,15 +2,22 @@
 
 import configparser, os, pandas, sys
 sys.dont_write_bytecode = True
-import collections, pickle, shutil
+sys.path.append('../Lib/')
+import collections, hashlib, pickle, shutil, tempfile, numpy, scipy.sparse
+import tokcache, ingest, ragged, vocab, utils
 
 MODEL_DIR = 'Model/'
-ALPHABET_FILE = 'Model/alphabet.txt'
-ALPHABET_PICKLE = 'Model/alphabet.p'
-CODE_FREQ_FILE = 'Model/codes.txt'
+ALPHABET_FILE = 'alphabet.txt'
+ALPHABET_VOCAB = 'alphabet.bin'
+CODE_FREQ_FILE = 'codes.txt'
+STATE_PICKLE = 'state.p'
+ARTIFACT_VERSION = 1
 DIAG_ICD9_FILE = 'DIAGNOSES_ICD.csv'
 PROC_ICD9_FILE = 'PROCEDURES_ICD.csv'
 CPT_CODE_FILE = 'CPTEVENTS.csv'
+CACHE_DIR = 'Cache/'
+CODE_CHUNK_SIZE = 1000000 # rows of code files read at a time
+SIZE_SLACK = 2.0 # reject cui files this much larger than expected
 
 class DatasetProvider:
   """THYME relation data"""
@@ -21,7 +28,9 @@ class DatasetProvider:
                min_token_freq,
                max_tokens_in_file,
                min_examples_per_code,
-               use_cuis=True):
+               use_cuis=True,
+               cache_dir=CACHE_DIR,
+               processes=None):
     """Index words by frequency in a file"""
 
     self.corpus_path = corpus_path
@@ -30,23 +39,42 @@ class DatasetProvider:
     self.max_tokens_in_file = max_tokens_in_file
     self.min_examples_per_code = min_examples_per_code
     self.use_cuis = use_cuis
+    self.cache_dir = cache_dir # tokenized files; None to disable
+    self.processes = processes # tokenizer processes; None for all cores
 
     self.token2int = {}  # words indexed by frequency
     self.code2int = {}   # class to int mapping
-    self.subj2codes = {} # subj_id to set of icd9 codes
+    self.col2int = None  # column of subj_codes to class
 
-    # remove old model directory and make a fresh one
-    if os.path.isdir(MODEL_DIR):
-      print('removing old model directory...')
-      shutil.rmtree(MODEL_DIR)
-    print('making alphabet and saving it in file...')
-    os.mkdir(MODEL_DIR)
-    self.make_and_write_token_alphabet()
+    # subjects (rows) by codes (columns) binary csr matrix
+    self.code_pairs = []    # unique (subj_id, code) frames
+    self.subj2row = {}      # subj_id to row of subj_codes
+    self.code_names = []    # column of subj_codes to code
+    self.subj_codes = None
 
-    print('mapping codes...')
+    # corpus is read only once; files are kept as arrays of
+    # provisional token ids which are mapped to alphabet later
+    self.file2ids = collections.OrderedDict()
+    self.id2int = None   # provisional id to alphabet index
+
+    # artifacts are kept in a directory named after a hash
+    # of their inputs and reused while the inputs don't change
     diag_code_file = os.path.join(self.code_dir, DIAG_ICD9_FILE)
     proc_code_file = os.path.join(self.code_dir, PROC_ICD9_FILE)
     cpt_code_file = os.path.join(self.code_dir, CPT_CODE_FILE)
+    self.artifact_dir = self.get_artifact_dir(
+      [diag_code_file, proc_code_file, cpt_code_file],
+      [min_token_freq, max_tokens_in_file, min_examples_per_code, use_cuis])
+
+    if self.load_artifacts():
+      print('reusing artifacts in', self.artifact_dir)
+      self.publish_artifacts()
+      return
+
+    print('making alphabet and saving it in file...')
+    self.make_and_write_token_alphabet()
+
+    print('mapping codes...')
     self.index_codes(
       diag_code_file,
       'HADM_ID',
@@ -65,21 +93,85 @@ class DatasetProvider:
       'CPT_NUMBER',
       'cpt',
       5)
+    self.make_subject_codes()
     self.make_code_alphabet()
 
+    self.save_artifacts()
+    self.publish_artifacts()
+
+  def get_artifact_dir(self, code_files, params):
+    """Make directory named after a hash of corpus, codes, and params"""
+
+    md5 = hashlib.md5()
+    md5.update(repr((ARTIFACT_VERSION,
+                     type(self).__name__,
+                     os.path.abspath(self.corpus_path),
+                     params)).encode('utf-8'))
+
+    # corpus manifest and code files
+    for file in sorted(os.listdir(self.corpus_path)):
+      stat = os.stat(os.path.join(self.corpus_path, file))
+      md5.update(('%s|%d|%d\n' % (file, stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+    for path in code_files:
+      stat = os.stat(path)
+      md5.update(('%s|%d|%d\n' % (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+
+    artifact_dir = os.path.join(MODEL_DIR, md5.hexdigest()[:16])
+    if not os.path.isdir(artifact_dir):
+      os.makedirs(artifact_dir)
+
+    return artifact_dir
+
+  def load_artifacts(self):
+    """Restore alphabets and token ids from artifact_dir if there"""
+
+    state_path = os.path.join(self.artifact_dir, STATE_PICKLE)
+    if not os.path.isfile(state_path):
+      return False
+
+    state = pickle.load(open(state_path, 'rb'))
+    for name, value in state.items():
+      setattr(self, name, value)
+
+    return True
+
+  def save_artifacts(self):
+    """Save state needed by load(); written last to mark completion"""
+
+    names = ['token2int', 'id2int', 'file2ids', 'code2int', 'col2int',
+             'subj2row', 'code_names', 'subj_codes']
+    state = dict((name, getattr(self, name))
+                 for name in names if hasattr(self, name))
+
+    # closed before the rename; a unique temp file so that
+    # processes making the same artifacts don't clash
+    fd, state_tmp = tempfile.mkstemp(dir=self.artifact_dir)
+    with os.fdopen(fd, 'wb') as state_file:
+      pickle.dump(state, state_file, pickle.HIGHEST_PROTOCOL)
+    os.replace(state_tmp, os.path.join(self.artifact_dir, STATE_PICKLE))
+
+  def publish_artifacts(self):
+    """Copy current artifacts to MODEL_DIR where other scripts expect them"""
+
+    for file in (ALPHABET_FILE, ALPHABET_VOCAB, CODE_FREQ_FILE):
+      source = os.path.join(self.artifact_dir, file)
+      if os.path.isfile(source):
+        fd, target_tmp = tempfile.mkstemp(dir=MODEL_DIR)
+        os.close(fd)
+        shutil.copy(source, target_tmp) # and its permissions
+        os.replace(target_tmp, os.path.join(MODEL_DIR, file))
+
   def read_tokens(self, file_name):
     """Return file as a list of ngrams"""
 
     infile = os.path.join(self.corpus_path, file_name)
-    text = open(infile).read().lower()
 
     tokens = [] # file as a list of tokens
-    for token in text.split():
-      if token.isalpha(): # TODO: need numeric tokens?
-        tokens.append(token)
-
-    if len(tokens) > self.max_tokens_in_file:
-      return None
+    for chunk in utils.read_token_chunks(infile, lower=True):
+      # TODO: need numeric tokens?
+      tokens.extend(token for token in chunk if token.isalpha())
+      if len(tokens) > self.max_tokens_in_file:
+        return None # no need to read the rest
 
     return tokens
 
@@ -87,42 +179,160 @@ class DatasetProvider:
     """Return file as a list of CUIs"""
 
     infile = os.path.join(self.corpus_path, file_name)
-    text = open(infile).read() # no lowercasing!
-    tokens = [token for token in text.split()]
-    if len(tokens) > self.max_tokens_in_file:
-      return None
+
+    tokens = [] # no lowercasing!
+    for chunk in utils.read_token_chunks(infile):
+      tokens.extend(chunk)
+      if len(tokens) > self.max_tokens_in_file:
+        return None # no need to read the rest
 
     return tokens
 
+  def read_file(self, file_name):
+    """Return file as a list of CUIs or tokens"""
+
+    if self.use_cuis:
+      return self.read_cuis(file_name)
+    else:
+      return self.read_tokens(file_name)
+
+  def read_corpus(self):
+    """Read each file once and return token counts"""
+
+    # files that did not change since the last run
+    # are read from the cache instead of being re-tokenized
+    cache_path = None
+    if self.cache_dir != None:
+      mode = 'cuis' if self.use_cuis else 'tokens'
+      cache_path = os.path.join(self.cache_dir, mode)
+    cache = tokcache.TokenCache(cache_path)
+
+    files = os.listdir(self.corpus_path)
+    paths = [os.path.join(self.corpus_path, file) for file in files]
+
+    # cui files much larger than the largest cached file
+    # of max_tokens_in_file tokens are rejected without reading
+    max_size = None
+    bytes_per_token = cache.max_bytes_per_token()
+    if self.use_cuis and bytes_per_token != None:
+      max_size = SIZE_SLACK * bytes_per_token * (self.max_tokens_in_file + 1)
+
+    # tokenize new or changed files in a process pool
+    misses = []
+    for i, path in enumerate(paths):
+      if cache.is_fresh(path, self.max_tokens_in_file):
+        continue
+      if max_size != None and os.path.getsize(path) > max_size:
+        cache.put(path, None, self.max_tokens_in_file)
+        continue
+      misses.append(i)
+    miss_tokens, _, miss_ids = ingest.read_files(
+      self.read_file,
+      [files[i] for i in misses],
+      self.processes)
+    remap = cache.add_tokens(miss_tokens)
+    for i, ids in zip(misses, miss_ids):
+      if ids is not None:
+        ids = remap[ids]
+      cache.put(paths[i], ids, self.max_tokens_in_file)
+
+    for file, path in zip(files, paths):
+      ids = cache.get(path, self.max_tokens_in_file)
+      if ids is None:
+        continue # file too long
+      self.file2ids[file] = ids
+    cache.save()
+
+    # renumber tokens in order of first occurrence
+    # which is also the insertion order of a collections.Counter
+    flat = numpy.concatenate(
+      [numpy.zeros(0, dtype=numpy.int32)] + list(self.file2ids.values()))
+    present, first = numpy.unique(flat, return_index=True)
+    present = present[numpy.argsort(first)]
+    remap = numpy.zeros(len(cache.vocab), dtype=numpy.int32)
+    remap[present] = numpy.arange(len(present))
+    for file, ids in self.file2ids.items():
+      self.file2ids[file] = remap[ids]
+
+    tokens = [cache.vocab[i] for i in present]
+    counts = numpy.bincount(remap[flat], minlength=len(present))
+
+    return tokens, counts
+
   def make_and_write_token_alphabet(self):
     """Write unique corpus tokens to file"""
 
     # count tokens in the entire corpus
-    token_counts = collections.Counter()
-    for file in os.listdir(self.corpus_path):
-      file_ngram_list = None
-      if self.use_cuis:
-        file_ngram_list = self.read_cuis(file)
-      else:
-        file_ngram_list = self.read_tokens(file)
-      if file_ngram_list == None:
-        continue
-      token_counts.update(file_ngram_list)
+    tokens, counts = self.read_corpus()
+
+    # stable sort breaks ties like Counter.most_common()
+    order = numpy.argsort(-counts, kind='stable')
 
     # now make alphabet
     # and save it in a file for debugging
     index = 1
     self.token2int['oov_word'] = 0
-    outfile = open(ALPHABET_FILE, 'w')
-    for token, count in token_counts.most_common():
+    self.id2int = numpy.zeros(len(tokens), dtype=numpy.int32)
+    outfile = open(os.path.join(self.artifact_dir, ALPHABET_FILE), 'w')
+    for pid in order:
+      token, count = tokens[pid], counts[pid]
       outfile.write('%s|%s\n' % (token, count))
       if count > self.min_token_freq:
         self.token2int[token] = index
+        self.id2int[pid] = index
         index = index + 1
 
-    # pickle alphabet
-    pickle_file = open(ALPHABET_PICKLE, 'wb')
-    pickle.dump(self.token2int, pickle_file)
+    # binary alphabet; see vocab.load_alphabet()
+    token_counts = dict(zip(tokens, counts.tolist()))
+    vocab.write_vocab(
+      os.path.join(self.artifact_dir, ALPHABET_VOCAB),
+      self.token2int,
+      token_counts)
+
+  def to_example(self, ids, maxlen, tokens_as_set):
+    """Map provisional ids of a file to an array of alphabet indices"""
+
+    if tokens_as_set:
+      ids = numpy.unique(ids)
+
+    # unknown tokens were mapped to oov_word (0) above
+    example = self.id2int[ids]
+
+    if len(example) > maxlen:
+      example = example[0:maxlen]
+
+    return example
+
+  def to_examples(self, examples, as_ragged):
+    """Return examples as lists of ints or as a RaggedArray"""
+
+    if as_ragged:
+      return ragged.RaggedArray.from_sequences(examples)
+
+    return [example.tolist() for example in examples]
+
+  def to_codes(self, codes, sparse_codes):
+    """Return code columns of each example as a binary matrix"""
+
+    if sparse_codes:
+      # csr matrix; rows are densified one batch at a time
+      indptr = numpy.cumsum([0] + [len(cols) for cols in codes])
+      indices = numpy.concatenate(
+        [numpy.zeros(0, dtype=numpy.int32)] + \
+        [numpy.sort(numpy.array(cols, dtype=numpy.int32)) for cols in codes])
+      data = numpy.ones(len(indices), dtype=numpy.int8)
+      return scipy.sparse.csr_matrix(
+        (data, indices, indptr),
+        shape=(len(codes), len(self.code2int)))
+
+    code_vecs = []
+    for cols in codes:
+      code_vec = [0] * len(self.code2int)
+      for col in cols:
+        code_vec[col] = 1
+      code_vecs.append(code_vec)
+
+    return code_vecs
 
   def index_codes(self,
                   code_file,
@@ -130,89 +340,103 @@ class DatasetProvider:
                   code_col,
                   prefix,
                   num_digits):
-    """Map subjects or hospital admissions to codes"""
+    """Map subjects or hospital admissions to codes; call
+    make_subject_codes() after the last code file"""
 
-    frame = pandas.read_csv(code_file, dtype='str')
+    pairs = [] # unique pairs from each chunk
+    reader = pandas.read_csv(
+      code_file,
+      usecols=[id_col, code_col],
+      dtype='str',
+      chunksize=CODE_CHUNK_SIZE)
 
-    for subj_id, code in zip(frame[id_col], frame[code_col]):
-      if pandas.isnull(subj_id):
-        continue # some subjects skipped (e.g. 13567)
-      if pandas.isnull(code):
-        continue
-      if subj_id not in self.subj2codes:
-        self.subj2codes[subj_id] = set()
-      short_code = '%s_%s' % (prefix, code[0:num_digits])
-      self.subj2codes[subj_id].add(short_code)
+    for chunk in reader:
+      # some subjects skipped (e.g. 13567)
+      chunk = chunk.dropna()
+      short_codes = prefix + '_' + chunk[code_col].str[0:num_digits]
+      frame = pandas.DataFrame({'subj': chunk[id_col], 'code': short_codes})
+      pairs.append(frame.drop_duplicates())
+
+    self.code_pairs.append(pandas.concat(pairs))
+
+  def make_subject_codes(self):
+    """Make binary subject by code matrix from code pairs"""
+
+    # a code can appear in several chunks and code files
+    pairs = pandas.concat(self.code_pairs).groupby(
+      ['subj', 'code'],
+      sort=False).size().reset_index()
+
+    rows, subjects = pandas.factorize(pairs['subj'])
+    cols, codes = pandas.factorize(pairs['code'])
+    self.subj2row = dict((subj, row) for row, subj in enumerate(subjects))
+    self.code_names = list(codes)
+    self.subj_codes = scipy.sparse.csr_matrix(
+      (numpy.ones(len(rows), dtype=numpy.int8), (rows, cols)),
+      shape=(len(subjects), len(codes)))
+
+  def get_code_columns(self, subj_id):
+    """Columns of subj_codes for codes of this subject"""
+
+    row = self.subj2row[subj_id]
+    start, end = self.subj_codes.indptr[row:row+2]
+
+    return self.subj_codes.indices[start:end]
 
   def make_code_alphabet(self):
     """Map codes to integers"""
 
     # count code frequencies and write them to file
-    code_counter = collections.Counter()
-    for codes in list(self.subj2codes.values()):
-      code_counter.update(codes)
-    outfile = open(CODE_FREQ_FILE, 'w')
-    for code, count in code_counter.most_common():
-      outfile.write('%s|%s\n' % (code, count))
+    # stable sort breaks ties by order of first occurrence
+    code_counts = numpy.bincount(
+      self.subj_codes.indices,
+      minlength=len(self.code_names))
+    order = numpy.argsort(-code_counts, kind='stable')
+    outfile = open(os.path.join(self.artifact_dir, CODE_FREQ_FILE), 'w')
+    for col in order:
+      outfile.write('%s|%s\n' % (self.code_names[col], code_counts[col]))
 
     # make code alphabet for frequent codes
+    # and map matrix columns to alphabet indices
     index = 0
-    for code, count in code_counter.most_common():
-      if count > self.min_examples_per_code:
-        self.code2int[code] = index
+    self.col2int = numpy.full(len(self.code_names), -1, dtype=numpy.int64)
+    for col in order:
+      if code_counts[col] > self.min_examples_per_code:
+        self.code2int[self.code_names[col]] = index
+        self.col2int[col] = index
         index = index + 1
 
   def load(self,
            maxlen=float('inf'),
-           tokens_as_set=True):
+           tokens_as_set=True,
+           as_ragged=False,
+           sparse_codes=False):
     """Convert examples into lists of indices"""
 
     codes = []    # each example has multiple codes
     examples = [] # int sequence represents each example
 
-    for file in os.listdir(self.corpus_path):
-      file_ngram_list = None
-      if self.use_cuis == True:
-        file_ngram_list = self.read_cuis(file)
-      else:
-        file_ngram_list = self.read_tokens(file)
-      if file_ngram_list == None:
-        continue # file too long
+    for file, ids in self.file2ids.items():
 
       # make code vector for this example
       subj_id = file.split('.')[0]
-      if subj_id not in self.subj2codes:
+      if subj_id not in self.subj2row:
         continue # subject was present once with no code
-      if len(self.subj2codes[subj_id]) == 0:
-        continue # shouldn't happen
 
-      code_vec = [0] * len(self.code2int)
-      for icd9_category in self.subj2codes[subj_id]:
-        if icd9_category in self.code2int:
-          # this icd9 has enough examples
-          code_vec[self.code2int[icd9_category]] = 1
+      # keep only codes that have enough examples
+      code_cols = self.col2int[self.get_code_columns(subj_id)]
+      code_cols = code_cols[code_cols >= 0]
 
-      if sum(code_vec) == 0:
+      if len(code_cols) == 0:
         continue # all rare codes for this file
 
-      codes.append(code_vec)
+      codes.append(code_cols)
 
       # represent this example as a list of ints
-      example = []
-
-      if tokens_as_set:
-        file_ngram_list = set(file_ngram_list)
-
-      for token in file_ngram_list:
-        if token in self.token2int:
-          example.append(self.token2int[token])
-        else:
-          example.append(self.token2int['oov_word'])
-
-      if len(example) > maxlen:
-        example = example[0:maxlen]
+      examples.append(self.to_example(ids, maxlen, tokens_as_set))
 
-      examples.append(example)
+    examples = self.to_examples(examples, as_ragged)
+    codes = self.to_codes(codes, sparse_codes)
 
     return examples, codes
 
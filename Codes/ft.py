@@ -26,14 +26,13 @@ from sklearn.model_selection import train_test_split
 import keras as k
 from keras.utils.np_utils import to_categorical
 from keras.optimizers import RMSprop
-from keras.preprocessing.sequence import pad_sequences
 from keras.models import Sequential
 from keras.layers.core import Dense, Activation, Dropout
 from keras.layers import GlobalAveragePooling1D
 from keras.layers.embeddings import Embedding
 from keras.models import load_model
 from keras.callbacks import Callback
-import dataset, word2vec, callback
+import dataset, word2vec, callback, batches
 
 # ignore sklearn warnings
 def warn(*args, **kwargs):
@@ -56,6 +55,8 @@ def print_config(cfg):
   print('embdims:', cfg.get('dan', 'embdims'))
   print('hidden:', cfg.get('dan', 'hidden'))
   print('learnrt:', cfg.get('dan', 'learnrt'))
+  if cfg.has_option('dan', 'bucket'):
+    print('bucket:', cfg.get('dan', 'bucket'))
 
 def get_model(cfg, init_vectors, num_of_features):
   """Model definition"""
@@ -63,7 +64,7 @@ def get_model(cfg, init_vectors, num_of_features):
   model = Sequential()
   model.add(Embedding(input_dim=num_of_features,
                       output_dim=cfg.getint('dan', 'embdims'),
-                      input_length=maxlen,
+                      input_length=None if bucket else maxlen,
                       trainable=True,
                       weights=init_vectors,
                       name='EL'))
@@ -96,27 +97,39 @@ if __name__ == "__main__":
     cfg.getint('args', 'min_token_freq'),
     cfg.getint('args', 'max_tokens_in_file'),
     cfg.getint('args', 'min_examples_per_code'))
-  x, y = dataset.load()
-  train_x, val_x, train_y, val_y = train_test_split(
-    x,
-    y,
+  x, y = dataset.load(as_ragged=True, sparse_codes=True)
+  train_idx, val_idx = train_test_split(
+    np.arange(len(x)),
     test_size=cfg.getfloat('args', 'test_size'))
-  maxlen = max([len(seq) for seq in train_x])
+  train_x, val_x = x[train_idx], x[val_idx]
+  train_y, val_y = y[train_idx], y[val_idx]
+  maxlen = int(train_x.lengths().max())
+
+  # batches of similar length padded to their own max length
+  bucket = cfg.has_option('dan', 'bucket') and cfg.getboolean('dan', 'bucket')
 
   init_vectors = None
   if cfg.has_option('data', 'embed'):
     embed_file = os.path.join(base, cfg.get('data', 'embed'))
-    w2v = word2vec.Model(embed_file)
-    init_vectors = [w2v.select_vectors(dataset.token2int)]
+    init_vectors = [word2vec.load_vectors(embed_file, dataset.token2int)]
 
-  # turn x into numpy array among other things
+  # training batches are padded and densified on the fly
   classes = len(dataset.code2int)
-  train_x = pad_sequences(train_x, maxlen=maxlen)
-  val_x = pad_sequences(val_x, maxlen=maxlen)
-  train_y = np.array(train_y)
-  val_y = np.array(val_y)
-
-  print('train_x shape:', train_x.shape)
+  val_y = val_y.toarray()
+
+  # bucketed validation is padded the same way as training
+  val_batches = None
+  if bucket:
+    val_batches = batches.PaddedBatches(
+      val_x,
+      val_y,
+      cfg.getint('dan', 'batch'),
+      maxlen,
+      shuffle=False,
+      bucket=True)
+  val_x = val_x.pad(maxlen)
+
+  print('train_x examples:', len(train_x))
   print('train_y shape:', train_y.shape)
   print('val_x shape:', val_x.shape)
   print('val_y shape:', val_y.shape)
@@ -132,13 +145,17 @@ if __name__ == "__main__":
   model.compile(loss='binary_crossentropy',
                 optimizer=optimizer,
                 metrics=['accuracy'])
-  model.fit(train_x,
-            train_y,
-            callbacks=[callback.Metrics()] if val_x.shape[0]>0 else None,
-            validation_data=(val_x, val_y) if val_x.shape[0]>0 else None,
-            epochs=cfg.getint('dan', 'epochs'),
-            batch_size=cfg.getint('dan', 'batch'),
-            validation_split=0.0)
+  train_batches = batches.PaddedBatches(
+    train_x,
+    train_y,
+    cfg.getint('dan', 'batch'),
+    maxlen,
+    bucket=bucket)
+  validation_data = (val_x, val_y) if val_batches == None else val_batches
+  model.fit_generator(train_batches,
+                      callbacks=[callback.Metrics(val_batches)] if val_x.shape[0]>0 else None,
+                      validation_data=validation_data if val_x.shape[0]>0 else None,
+                      epochs=cfg.getint('dan', 'epochs'))
 
   model.save(MODEL_FILE)
 
@@ -147,7 +164,10 @@ if __name__ == "__main__":
     exit()
 
   # probability for each class; (test size, num of classes)
-  distribution = model.predict(val_x)
+  if val_batches != None:
+    distribution = batches.predict(model, val_batches)
+  else:
+    distribution = model.predict(val_x)
 
   # turn into an indicator matrix
   distribution[distribution < 0.5] = 0
@@ -26,14 +26,13 @@ from sklearn.model_selection import train_test_split
 import keras as k
 from keras.utils.np_utils import to_categorical
 from keras.optimizers import RMSprop
-from keras.preprocessing.sequence import pad_sequences
 from keras.models import Sequential
 from keras.layers.core import Dense, Activation, Dropout
 from keras.layers import GlobalAveragePooling1D
 from keras.layers.embeddings import Embedding
 from keras.models import load_model
 from keras import regularizers
-import dataset, word2vec
+import dataset, embcache, budget
 from random_search import RandomSearch
 
 # ignore sklearn warnings
@@ -44,12 +43,19 @@ warnings.warn = warn
 
 RESULTS_FILE = 'Model/results.txt'
 MODEL_FILE = 'Model/model.h5'
+TRIALS_FILE = 'Model/trials.jsonl'
+CHECKPOINT_DIR = 'Model/Checkpoints/'
+EMBED_CACHE_DIR = 'Cache/embed/'
 
 class CodePredictionModel:
 
-  def __init__(self):
+  def __init__(self, embed_file=None, token2int=None):
     """Configuration parameters"""
 
+    # no globals; search workers get a pickled copy
+    self.embed_file = embed_file
+    self.token2int = token2int
+
     self.configs = {};
 
     self.configs['batch'] = (8, 16, 32, 64, 128, 256)
@@ -101,17 +107,36 @@ class CodePredictionModel:
 
     return model
 
-  def run_one_eval(self, train_x, train_y, valid_x, valid_y, epochs, config):
-    """A single eval"""
+  def run_one_eval(self,
+                   train_x,
+                   train_y,
+                   valid_x,
+                   valid_y,
+                   epochs,
+                   config,
+                   checkpoint=None,
+                   initial_epoch=0,
+                   initial_checkpoint=None,
+                   deadline=None):
+    """A single eval; continues from initial_checkpoint (trained for
+    initial_epoch epochs) if given and saves model to checkpoint;
+    training stops early at the deadline (see budget.py)"""
+
+    if initial_checkpoint != None and os.path.isfile(initial_checkpoint):
+      model = load_model(initial_checkpoint)
+      return self.fit_and_evaluate(model, train_x, train_y, valid_x, valid_y,
+                                   epochs, config, checkpoint, initial_epoch, deadline)
 
     init_vectors = None
-    if config['embed']:
-      embed_file = os.path.join(base, cfg.get('data', 'embed'))
-      w2v = word2vec.Model(embed_file)
-      init_vectors = [w2v.select_vectors(dataset.token2int)]
+    if config['embed'] and self.embed_file != None:
+      # same matrix for every trial; parsed once per search
+      init_vectors = [embcache.load_vectors(
+        self.embed_file,
+        self.token2int,
+        EMBED_CACHE_DIR)]
 
     vocab_size = train_x.max() + 1
-    input_length = max([len(seq) for seq in x])
+    input_length = train_x.shape[1]
     output_units = train_y.shape[1]
 
     model = self.get_model(init_vectors,
@@ -122,12 +147,37 @@ class CodePredictionModel:
     model.compile(loss='binary_crossentropy',
                   optimizer=config['optimizer'],
                   metrics=['accuracy'])
+
+    return self.fit_and_evaluate(model, train_x, train_y, valid_x, valid_y,
+                                 epochs, config, checkpoint, deadline=deadline)
+
+  def fit_and_evaluate(self,
+                       model,
+                       train_x,
+                       train_y,
+                       valid_x,
+                       valid_y,
+                       epochs,
+                       config,
+                       checkpoint=None,
+                       initial_epoch=0,
+                       deadline=None):
+    """Train compiled model up to epochs and return 1 - f1"""
+
+    callbacks = []
+    if deadline != None:
+      callbacks.append(budget.DeadlineStopping(deadline))
+
     model.fit(train_x,
               train_y,
               epochs=epochs,
+              initial_epoch=initial_epoch,
               batch_size=config['batch'],
               validation_split=0.0,
-              verbose=0)
+              verbose=0,
+              callbacks=callbacks)
+    if checkpoint != None:
+      model.save(checkpoint)
 
     # probability for each class; (test size, num of classes)
     distribution = model.predict(valid_x)
@@ -156,13 +206,34 @@ if __name__ == "__main__":
     cfg.getint('args', 'min_token_freq'),
     cfg.getint('args', 'max_tokens_in_file'),
     cfg.getint('args', 'min_examples_per_code'))
-  x, y = dataset.load()
+  x, y = dataset.load(as_ragged=True)
 
-  maxlen = max([len(seq) for seq in x])
-  x = pad_sequences(x, maxlen=maxlen)
+  maxlen = int(x.lengths().max())
+  x = x.pad(maxlen)
   y = np.array(y)
 
-  model = CodePredictionModel()
-  search = RandomSearch(model, x, y)
-  best_config = search.optimize(max_iter=64)
-  print('best config:', best_config)
+  embed_file = None
+  if cfg.has_option('data', 'embed'):
+    embed_file = os.path.join(base, cfg.get('data', 'embed'))
+
+  # optional limits, e.g. to fit the search into a nightly window
+  budgets = budget.from_config(cfg)
+
+  model = CodePredictionModel(embed_file, dataset.token2int)
+  search = RandomSearch(model, x, y, TRIALS_FILE, CHECKPOINT_DIR)
+  if cfg.has_option('search', 'processes'):
+    # asynchronous successive halving on all workers
+    shared_dir = None # sharedmem.SHARED_DIR
+    if cfg.has_option('search', 'shared_dir'):
+      shared_dir = cfg.get('search', 'shared_dir')
+    best_config = search.optimize_async(
+      max_iter=64,
+      processes=cfg.getint('search', 'processes'),
+      shared_dir=shared_dir,
+      **budgets)
+  else:
+    best_config = search.optimize(max_iter=64, **budgets)
+  if best_config == None:
+    print('no eval finished within the search budget')
+  else:
+    print('best config:', best_config)
@@ -4,22 +4,87 @@
 #
 
 import numpy as np
-import time
+import concurrent.futures, gc, multiprocessing, os, time
+import tensorflow as tf
+from keras import backend as bke
 from sklearn.model_selection import train_test_split
+import trialstore, sharedmem, telemetry, budget
+
+# set in each worker process by init_worker()
+worker_model = None
+worker_data = None
+worker_threads = None
+
+def set_worker_session(threads):
+    """Keras session with capped thread pools"""
+    session_config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                    inter_op_parallelism_threads=threads)
+    bke.set_session(tf.Session(graph=tf.get_default_graph(), config=session_config))
+
+def init_worker(model, data, threads):
+    """Own tf session with capped thread pools; model is sent once and
+    the data arrives as sharedmem handles that are mapped, not copied"""
+    global worker_model, worker_data, worker_threads
+    worker_threads = threads
+    set_worker_session(threads)
+    worker_model = model
+    worker_data = sharedmem.attach(data)
+
+def epochs_to_train(epochs, checkpoint_args):
+    """Epochs an eval trains for; fewer if it continues from a checkpoint"""
+    initial_checkpoint = checkpoint_args.get('initial_checkpoint')
+    if initial_checkpoint != None and os.path.isfile(initial_checkpoint):
+        return epochs - checkpoint_args['initial_epoch']
+    return epochs
+
+def past(deadline):
+    """Has the deadline (None for no deadline) passed?"""
+    return deadline != None and time.time() >= deadline
+
+def run_worker_eval(epochs, config, checkpoint_args, deadline):
+    """Run one eval in a worker process; returns loss, its telemetry and
+    whether training was aborted at the deadline"""
+    meter = telemetry.Meter()
+    trained = epochs_to_train(epochs, checkpoint_args)
+    train_x, train_y, valid_x, valid_y = worker_data
+    loss = worker_model.run_one_eval(train_x, train_y, valid_x, valid_y, epochs, config,
+                                     deadline=deadline, **checkpoint_args)
+    stats = meter.stats(len(train_x), trained)
+
+    # workers live for the whole search; drop this eval's graph so memory
+    # doesn't grow, and since clear_session() also drops the capped session
+    # (keras would default to one using all cores) install it again
+    gc.collect()
+    bke.clear_session()
+    set_worker_session(worker_threads)
+
+    return loss, stats, past(deadline)
 
 class RandomSearch:
-    def __init__(self, model, train_x, train_y):
+    def __init__(self, model, train_x, train_y, trials_file=None, checkpoint_dir=None):
         self.model = model
+        self.trials_file = trials_file # finished evals; a rerun resumes from them
+        self.checkpoint_dir = checkpoint_dir # survivors continue from saved models
         self.train_x, self.valid_x, self.train_y, self.valid_y = train_test_split(train_x, train_y, test_size=0.2)
 
-    def optimize(self, max_iter=256):
+    def optimize(self, max_iter=256, time_budget=None, epoch_budget=None):
+        """Hyperband; when the time (seconds) or epoch budget runs out the search
+        stops and the best config among the longest trained evals is returned"""
         start_time = time.time()
+        search_budget = budget.Budget(time_budget, epoch_budget)
 
         eta = 4 # defines downsampling rate (default=3)
         logeta = lambda x: np.log(x)/np.log(eta)
         s_max = int(logeta(max_iter))  # number of unique executions of Successive Halving (minus one)
         B = (s_max+1)*max_iter  # total number of iterations (without reuse) per execution of Succesive Halving (n,r)
 
+        # evals of the same search that finished before
+        store = trialstore.TrialStore(self.trials_file, trialstore.make_spec(
+            'hyperband', max_iter, eta,
+            type(self.model).__name__,
+            trialstore.describe(getattr(self.model, 'configs', {})),
+            trialstore.data_digest(self.train_x, self.train_y, self.valid_x, self.valid_y)))
+
         #### Begin Finite Horizon Hyperband outlerloop. Repeat indefinetely.
         for s in reversed(list(range(s_max+1))):
             n = int(np.ceil(B/max_iter/(s+1)*eta**s)) # initial number of configurations
@@ -27,15 +92,215 @@ class RandomSearch:
             # print("Running s=%d, num configs=%d, num iters=%d" % (s, n, r) )
 
             #### Begin Finite Horizon Successive Halving with (n,r)
+            # always sample so that later brackets get the same configs as before
             T = [ self.model.get_random_config() for i in range(n) ]
+            bracket = store.find(kind='bracket', bracket=s)
+            if bracket == None:
+                store.add(kind='bracket', bracket=s, configs=T)
+            else:
+                T = bracket['configs']
             # print("Starting this halving iteration with %d configs" % ( len(T) ) )
+            C = list(range(len(T))) # position of each config in the bracket
+            r_prev = 0 # epochs the survivors were already trained for
             for i in range(s+1):
                 # Run each of the n_i configs for r_i iterations and keep best n_i/eta
                 n_i = n*eta**(-i)
                 r_i = int( r*eta**(i) )
-                val_losses = [ self.model.run_one_eval(self.train_x, self.train_y, self.valid_x, self.valid_y, r_i, t) for t in T ]
-                T = [ T[i] for i in np.argsort(val_losses)[0:int( n_i/eta )] ]
+                val_losses = []
+                for j, (c, t) in enumerate(zip(C, T)):
+                    loss = self.run_one_eval(store, search_budget, s, i, j, r_prev, r_i, c, t)
+                    if loss == None:
+                        # checkpoints are kept so that a rerun can resume
+                        print("Search budget exhausted")
+                        self.print_summary(store)
+                        return self.best_config(store)
+                    val_losses.append(loss)
+                keep = np.argsort(val_losses)[0:int( n_i/eta )]
+                self.remove_checkpoints(s, [c for k, c in enumerate(C) if k not in keep], r_i)
+                T = [ T[i] for i in keep ]
+                C = [ C[i] for i in keep ]
+                r_prev = r_i
                 print(("After iteration %d T has %d configurations" % (s, len(T))))
+            self.remove_checkpoints(s, C, r_prev)
             #### End Finite Horizon Successive Halving with (n,r)
 
+        self.print_summary(store)
+
         return T[0]
+
+    def optimize_async(self, max_iter=256, min_iter=1, max_configs=None, processes=None, threads=None,
+                       time_budget=None, epoch_budget=None, shared_dir=None):
+        """Asynchronous successive halving (ASHA): a config is promoted to the next rung
+        as soon as it ranks in the top 1/eta of the configs that finished its rung;
+        no evals start once the time (seconds) or epoch budget runs out; workers map
+        the data from shared_dir (sharedmem.SHARED_DIR if None)"""
+        search_budget = budget.Budget(time_budget, epoch_budget)
+        eta = 4 # same downsampling rate as optimize()
+        logeta = lambda x: np.log(x)/np.log(eta)
+        num_rungs = int(logeta(max_iter/min_iter)) + 1
+        # the top rung trains for max_iter even if max_iter/min_iter isn't a power of eta
+        rung_iters = [ int(min_iter*eta**k) for k in range(num_rungs-1) ] + [ max_iter ]
+        if max_configs == None:
+            max_configs = eta**(num_rungs-1) # as many as the largest hyperband bracket
+        if processes == None:
+            processes = os.cpu_count()
+        if threads == None:
+            threads = max(1, os.cpu_count() // processes)
+
+        store = trialstore.TrialStore(self.trials_file, trialstore.make_spec(
+            'asha', max_iter, min_iter, eta, max_configs,
+            type(self.model).__name__,
+            trialstore.describe(getattr(self.model, 'configs', {})),
+            trialstore.data_digest(self.train_x, self.train_y, self.valid_x, self.valid_y)))
+
+        configs = [] # sampled configs; position is the config id
+        losses = [ {} for k in range(num_rungs) ] # config id -> loss in each rung
+        promoted = [ set() for k in range(num_rungs) ] # config ids promoted from each rung
+        for record in store.records: # evals that finished before
+            if record['kind'] == 'config':
+                configs.append(record['config'])
+            elif record['kind'] == 'eval':
+                losses[record['rung']][record['id']] = record['loss']
+                if record['rung'] > 0:
+                    promoted[record['rung']-1].add(record['id'])
+
+        started = set() # config ids whose first eval was started
+        def next_job():
+            # promote from the highest rung possible, else start a new config
+            for k in reversed(list(range(num_rungs-1))):
+                ranked = sorted(losses[k], key=losses[k].get)
+                for c in ranked[0:len(ranked)//eta]:
+                    if c not in promoted[k]:
+                        promoted[k].add(c)
+                        return c, k+1
+            for c in range(len(configs)): # sampled before but never evaluated
+                if c not in losses[0] and c not in started:
+                    started.add(c)
+                    return c, 0
+            if len(configs) < max_configs:
+                configs.append(self.model.get_random_config())
+                store.add(kind='config', id=len(configs)-1, config=configs[-1])
+                started.add(len(configs)-1)
+                return len(configs)-1, 0
+            return None
+
+        data = (self.train_x, self.train_y, self.valid_x, self.valid_y)
+        context = multiprocessing.get_context('spawn') # forking would share our tf session
+        with sharedmem.SharedArrays(shared_dir) as arrays, \
+             concurrent.futures.ProcessPoolExecutor(processes, mp_context=context, initializer=init_worker,
+                                                    initargs=(self.model, arrays.share(data), threads)) as pool:
+            running = {} # future -> (config id, rung, reserved epochs)
+            job = None # next eval; waits while it doesn't fit the budget
+            while True:
+                while len(running) < processes:
+                    if job == None:
+                        job = next_job()
+                    if job == None:
+                        break
+                    c, k = job
+                    previous = rung_iters[k-1] if k > 0 else 0
+                    checkpoint_args = self.checkpoint_args('asha', c, previous, rung_iters[k])
+                    trained = epochs_to_train(rung_iters[k], checkpoint_args)
+                    if not search_budget.reserve(trained):
+                        break # maybe once running evals are done
+                    future = pool.submit(run_worker_eval, rung_iters[k], configs[c], checkpoint_args,
+                                         search_budget.deadline)
+                    running[future] = (c, k, trained)
+                    job = None
+                if len(running) == 0:
+                    break # nothing to promote, no configs left or out of budget
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    c, k, trained = running.pop(future)
+                    loss, stats, aborted = future.result()
+                    search_budget.spend(trained, trained)
+                    if aborted:
+                        # a rerun trains this eval again from the previous rung
+                        print(("Config %d aborted in rung %d at the deadline" % (c, k)))
+                        self.remove_checkpoints('asha', [c], rung_iters[k])
+                        continue
+                    losses[k][c] = loss
+                    store.add(kind='eval', id=c, rung=k, config=configs[c], loss=loss,
+                              epochs=rung_iters[k], **stats)
+                    print(("Config %d finished rung %d with loss %.3f" % (c, k, loss)))
+                    if k > 0:
+                        self.remove_checkpoints('asha', [c], rung_iters[k-1])
+
+        if job != None:
+            # checkpoints are kept so that a rerun can resume
+            print("Search budget exhausted")
+            self.print_summary(store)
+            return self.best_config(store)
+
+        for k in range(num_rungs):
+            self.remove_checkpoints('asha', list(range(len(configs))), rung_iters[k])
+
+        self.print_summary(store)
+
+        # best config of the highest rung reached
+        reached = [ k for k in range(num_rungs) if len(losses[k]) > 0 ]
+        if len(reached) == 0:
+            return None # every eval was aborted (or max_configs is 0)
+        top = max(reached)
+        return configs[min(losses[top], key=losses[top].get)]
+
+    def best_config(self, store):
+        """Config with the lowest loss among the evals trained for the most epochs"""
+        evals = [r for r in store.records if r['kind'] == 'eval']
+        if len(evals) == 0:
+            return None # out of budget before the first eval finished
+        most = max(r['epochs'] for r in evals)
+        return min([r for r in evals if r['epochs'] == most], key=lambda r: r['loss'])['config']
+
+    def print_summary(self, store):
+        """Table of all evals with their telemetry, lowest loss first"""
+        print('\nevals sorted by loss:')
+        print(telemetry.summary([r for r in store.records if r['kind'] == 'eval'], score='loss', reverse=False))
+
+    def checkpoint_args(self, s, c, r_prev, r_i):
+        """Checkpoint arguments of run_one_eval (none without a checkpoint_dir)"""
+        if self.checkpoint_dir == None:
+            return {}
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        previous = self.checkpoint(s, c, r_prev) if r_prev > 0 else None
+        return {'checkpoint': self.checkpoint(s, c, r_i), 'initial_epoch': r_prev, 'initial_checkpoint': previous}
+
+    def checkpoint(self, s, c, epochs):
+        """Saved model of config c in bracket s after epochs"""
+        return os.path.join(self.checkpoint_dir, 'bracket%s_config%d_epoch%d.h5' % (s, c, epochs))
+
+    def remove_checkpoints(self, s, C, epochs):
+        """Drop saved models of eliminated (or finished) configs"""
+        if self.checkpoint_dir == None:
+            return
+        for c in C:
+            if os.path.isfile(self.checkpoint(s, c, epochs)):
+                os.remove(self.checkpoint(s, c, epochs))
+
+    def run_one_eval(self, store, search_budget, s, i, j, r_prev, r_i, c, t):
+        """Loss of config t (the j-th in rung i of bracket s), stored or evaluated;
+        with checkpoints only the epochs after r_prev are trained; None if
+        the eval doesn't fit the budget or is aborted at the deadline"""
+        record = store.find(kind='eval', bracket=s, rung=i, index=j)
+        if record != None:
+            return record['loss']
+
+        meter = telemetry.Meter()
+        checkpoint_args = self.checkpoint_args(s, c, r_prev, r_i)
+        trained = epochs_to_train(r_i, checkpoint_args)
+        if not search_budget.reserve(trained):
+            return None
+        loss = self.model.run_one_eval(self.train_x, self.train_y, self.valid_x, self.valid_y, r_i, t,
+                                       deadline=search_budget.deadline, **checkpoint_args)
+        search_budget.spend(trained, trained)
+        if past(search_budget.deadline):
+            # a rerun trains this eval again from the r_prev checkpoint
+            self.remove_checkpoints(s, [c], r_i)
+            return None
+        store.add(kind='eval', bracket=s, rung=i, index=j, config=t, loss=loss,
+                  epochs=r_i, **meter.stats(len(self.train_x), trained))
+        if self.checkpoint_dir != None and r_prev > 0:
+            self.remove_checkpoints(s, [c], r_prev)
+
+        return loss
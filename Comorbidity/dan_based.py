@@ -84,8 +84,7 @@ def get_embeddings(cfg, token2int):
 
   if cfg.has_option('data', 'embed'):
     embed_file = os.path.join(base, cfg.get('data', 'embed'))
-    w2v = word2vec.Model(embed_file)
-    init_vectors = [w2v.select_vectors(token2int)]
+    init_vectors = [word2vec.load_vectors(embed_file, token2int)]
 
   return init_vectors
 
@@ -3,10 +3,10 @@
 import sys
 sys.dont_write_bytecode = True
 sys.path.append('../Lib/')
-import utils, i2b2
-import numpy, pickle
+import utils, i2b2, ingest, vocab
+import numpy
 import configparser, os, nltk, pandas
-import glob, string, collections, operator
+import glob, string, operator
 
 # can be used to turn this into a binary task
 LABEL2INT = {'Y':0, 'N':1, 'Q':2, 'U':3}
@@ -24,7 +24,8 @@ class DatasetProvider:
                use_pickled_alphabet=False,
                alphabet_pickle=None,
                min_token_freq=0,
-               use_cuis=True):
+               use_cuis=True,
+               processes=None):
     """Index words by frequency in a file"""
 
     self.corpus_path = corpus_path
@@ -34,15 +35,15 @@ class DatasetProvider:
     self.judgement = judgement
     self.alphabet_pickle = alphabet_pickle
     self.use_cuis = use_cuis
+    self.processes = processes # None to use all cores
 
     self.token2int = {}
 
-    # when training, make alphabet and pickle it
-    # when testing, load it from pickle
+    # when training, make alphabet and write it
+    # when testing, load it (binary or legacy pickle)
     if use_pickled_alphabet:
       print('reading alphabet from', alphabet_pickle)
-      pkl = open(alphabet_pickle, 'rb')
-      self.token2int = pickle.load(pkl)
+      self.token2int = vocab.load_alphabet(alphabet_pickle)
     elif alphabet_pickle != None:
       self.make_token_alphabet()
     else:
@@ -52,16 +53,14 @@ class DatasetProvider:
     """Map tokens (CUIs) to integers"""
 
     # count tokens in the entire corpus
-    token_counts = collections.Counter()
-
-    for f in os.listdir(self.corpus_path):
-      file_path = os.path.join(self.corpus_path, f)
-      file_feat_list = None
-      if self.use_cuis:
-        file_feat_list = utils.read_cuis(file_path)
-      else:
-        file_feat_list = utils.read_tokens(file_path)
-      token_counts.update(file_feat_list)
+    # shards are merged in order so most_common() ties are stable
+    file_paths = [os.path.join(self.corpus_path, f)
+                  for f in os.listdir(self.corpus_path)]
+    read_file = utils.read_cuis if self.use_cuis else utils.read_tokens
+    _, token_counts, _ = ingest.read_files(
+      read_file,
+      file_paths,
+      self.processes)
 
     # now make alphabet (high freq tokens first)
     index = 1
@@ -73,9 +72,8 @@ class DatasetProvider:
         self.token2int[token] = index
         index = index + 1
 
-    # pickle alphabet
-    pickle_file = open(self.alphabet_pickle, 'wb')
-    pickle.dump(self.token2int, pickle_file)
+    # binary alphabet; see vocab.load_alphabet()
+    vocab.write_vocab(self.alphabet_pickle, self.token2int, token_counts)
 
   def load(self, maxlen=float('inf'), tokens_as_set=True):
     """Convert examples into lists of indices for keras"""
@@ -83,6 +81,7 @@ class DatasetProvider:
     labels = []    # int labels
     examples = []  # examples as int sequences
     no_labels = [] # docs with no labels
+    token2int = vocab.as_dict(self.token2int) # looked up per token
 
     # document id -> label mapping
     doc2label = i2b2.parse_standoff(
@@ -105,10 +104,10 @@ class DatasetProvider:
         file_feat_list = set(file_feat_list)
 
       for token in file_feat_list:
-        if token in self.token2int:
-          example.append(self.token2int[token])
+        if token in token2int:
+          example.append(token2int[token])
         else:
-          example.append(self.token2int['oov_word'])
+          example.append(token2int['oov_word'])
 
       if len(example) > maxlen:
         example = example[0:maxlen]
@@ -133,6 +132,7 @@ class DatasetProvider:
     labels = []    # int labels
     examples = []  # examples as int sequences
     no_labels = [] # docs with no labels
+    token2int = vocab.as_dict(self.token2int) # looked up per token
 
     # document id -> vector of labels
     doc2labels = i2b2.parse_standoff_vectorized(
@@ -149,10 +149,10 @@ class DatasetProvider:
       example = []
       # TODO: use unique tokens or not?
       for token in set(file_feat_list):
-        if token in self.token2int:
-          example.append(self.token2int[token])
+        if token in token2int:
+          example.append(token2int[token])
         else:
-          example.append(self.token2int['oov_word'])
+          example.append(token2int['oov_word'])
 
       if len(example) > maxlen:
         example = example[0:maxlen]
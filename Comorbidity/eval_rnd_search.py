@@ -8,7 +8,7 @@ import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 import sys
 sys.dont_write_bytecode = True
-import configparser, pickle, gc, keras
+import configparser, pickle, gc, keras, time
 from sklearn.svm import LinearSVC
 from sklearn.model_selection import cross_val_score
 from sklearn.model_selection import GridSearchCV
@@ -37,6 +37,8 @@ def warn(*args, **kwargs):
 import warnings
 warnings.warn = warn
 
+TRIALS_FILE = 'Model/trials.jsonl'
+
 def get_data(disease, judgement):
   """Sequences of tokens to feed into code prediction model"""
 
@@ -92,8 +94,9 @@ def make_model(args):
   """Model definition"""
 
   # load pretrained code prediction model
-  rl = cfg.get('data', 'rep_layer')
-  pretrained_model = load_model(cfg.get('data', 'model_file'))
+  # (paths are in args; search workers don't have cfg)
+  rl = args['rep_layer']
+  pretrained_model = load_model(args['model_file'])
   base_model = Model(inputs=pretrained_model.input,
                      outputs=pretrained_model.get_layer(rl).output)
 
@@ -128,8 +131,9 @@ def list_layers(model):
     else:
       print('%s: %s' % (layer.name, layer.trainable))
 
-def run_evaluation(disease, judgement):
-  """Use pre-trained patient representations"""
+def run_evaluation(disease, judgement, deadline=None):
+  """Use pre-trained patient representations; the search
+  stops at deadline (as returned by time.time()) if given"""
 
   x_train, y_train, x_test, y_test = get_data(disease, judgement)
   print('\ndisease: %s, classes: %d' % (disease, len(set(y_train))))
@@ -137,7 +141,9 @@ def run_evaluation(disease, judgement):
   fixed_args = {
     'epochs': cfg.getint('search', 'max_epochs'),
     'output_classes': len(set(y_train)),
-    'loss': 'sparse_categorical_crossentropy'}
+    'loss': 'sparse_categorical_crossentropy',
+    'model_file': cfg.get('data', 'model_file'),
+    'rep_layer': cfg.get('data', 'rep_layer')}
 
   param_space = {
     'dropout': uniform(0, 0.75),
@@ -145,13 +151,20 @@ def run_evaluation(disease, judgement):
     'log10lr': (-5, -4, -3, -2, -1),
     'batch': (2, 4, 8, 16, 32, 64)}
 
+  # processes, sampler, prune and budgets from [search]
+  options = rndsearch.options_from_config(cfg, param_space)
+  if deadline != None:
+    options['time_budget'] = max(0, deadline - time.time()) # what's left
+
   config2score = rndsearch.run(
     make_model,
     fixed_args,
     param_space,
     x_train,
     y_train,
-    n=cfg.getint('search', 'n'))
+    n=cfg.getint('search', 'n'),
+    trials_file=TRIALS_FILE,
+    **options)
 
   # display configs sorted by f1
   print('\nconfigurations sorted by score:')
@@ -159,6 +172,10 @@ def run_evaluation(disease, judgement):
   for config in sorted_by_value:
     print('%s: %.3f' % (config, config2score[config]))
 
+  if len(config2score) == 0:
+    print('no trial finished within the search budget')
+    return None # nothing to evaluate
+
   best_config = dict(sorted_by_value[-1])
   print('best config:', best_config)
   print('best score:', config2score[sorted_by_value[-1]])
@@ -196,9 +213,17 @@ def run_evaluation_all_diseases():
   evaluation = cfg.get('data', 'evaluation')
   test_annot = os.path.join(base, cfg.get('data', 'test_annot'))
 
+  # time_budget is shared by all diseases, epoch_budget is per disease
+  deadline = None
+  if cfg.has_option('search', 'time_budget'):
+    deadline = time.time() + cfg.getint('search', 'time_budget')
+
   ps = []; rs = []; f1s = []
   for disease in i2b2.get_disease_names(test_annot, set()):
-    p, r, f1 = run_evaluation(disease, judgement)
+    scores = run_evaluation(disease, judgement, deadline)
+    if scores == None:
+      continue # out of search budget
+    p, r, f1 = scores
     ps.append(p)
     rs.append(r)
     f1s.append(f1)
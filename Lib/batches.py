@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import scipy.sparse
+from keras.utils import Sequence
+
+class PaddedBatches(Sequence):
+  """Pad examples and densify labels one batch at a time"""
+
+  def __init__(self,
+               x,
+               y,
+               batch_size,
+               maxlen=None,
+               shuffle=True,
+               bucket=False,
+               min_len=1):
+    """x is a RaggedArray; y is a numpy array or sparse matrix"""
+
+    self.x = x
+    self.y = y
+    self.batch_size = batch_size
+    self.maxlen = maxlen   # pad (or truncate) to this length
+    self.shuffle = shuffle
+    self.bucket = bucket   # batch examples of similar length
+    self.min_len = min_len # e.g. cnn filter length
+
+    # bucketed batches are only as wide as their longest example
+    self.lengths = x.lengths()
+    if self.maxlen == None:
+      self.maxlen = max(self.min_len, int(self.lengths.max()))
+
+    self.make_batches()
+
+  def make_batches(self):
+    """Split (shuffled) examples into batches"""
+
+    order = np.arange(len(self.x))
+    if self.shuffle:
+      np.random.shuffle(order)
+
+    if self.bucket:
+      # shuffled order breaks ties between equal lengths
+      order = order[np.argsort(self.lengths[order], kind='stable')]
+
+    self.batches = [order[i:i+self.batch_size]
+                    for i in range(0, len(order), self.batch_size)]
+
+    if self.bucket and self.shuffle:
+      # don't go from short to long batches every epoch
+      np.random.shuffle(self.batches)
+
+  def __len__(self):
+    """Number of batches per epoch"""
+
+    return len(self.batches)
+
+  def __getitem__(self, index):
+    """Padded examples and dense labels for batch index"""
+
+    rows = self.batches[index]
+
+    maxlen = self.maxlen
+    if self.bucket:
+      batch_len = max(self.min_len, int(self.lengths[rows].max()))
+      maxlen = min(maxlen, batch_len)
+
+    batch_x = self.x[rows].pad(maxlen)
+    batch_y = self.y[rows]
+    if scipy.sparse.issparse(batch_y):
+      batch_y = batch_y.toarray()
+
+    return batch_x, batch_y
+
+  def on_epoch_end(self):
+    """Reshuffle like fit(shuffle=True) does"""
+
+    if self.shuffle:
+      self.make_batches()
+
+def predict(model, padded_batches):
+  """Predictions for all examples of padded_batches (e.g. bucketed
+  validation data) in the order of its x"""
+
+  outputs = None
+  for index in range(len(padded_batches)):
+    batch_x, _ = padded_batches[index]
+    batch_outputs = model.predict_on_batch(batch_x)
+    if outputs is None:
+      shape = (len(padded_batches.x),) + batch_outputs.shape[1:]
+      outputs = np.zeros(shape, dtype=batch_outputs.dtype)
+    outputs[padded_batches.batches[index]] = batch_outputs
+
+  return outputs
+
+if __name__ == "__main__":
+
+  print()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import time
+from keras.callbacks import Callback
+
+class Budget:
+  """Wall clock time and/or total training epochs a search may
+  use; a trial starts only if its epochs fit (or, if partial,
+  with as many as are left)"""
+
+  def __init__(self, seconds=None, epochs=None):
+    """No limit for whichever is None"""
+
+    self.deadline = None if seconds == None else time.time() + seconds
+    self.epochs = epochs
+    self.used = 0     # epochs trained by finished trials
+    self.reserved = 0 # at most this many by running trials
+
+  def expired(self):
+    """Is it past the deadline?"""
+
+    return self.deadline != None and time.time() >= self.deadline
+
+  def reserve(self, epochs, partial=False):
+    """Epochs a trial of up to this many epochs may train for
+    if it starts now (0 if it can't); they are set aside until
+    it finishes"""
+
+    if self.expired():
+      return 0
+    if self.epochs != None:
+      left = self.epochs - self.used - self.reserved
+      if left < epochs:
+        if not partial or left <= 0:
+          return 0
+        epochs = left
+
+    self.reserved = self.reserved + epochs
+    return epochs
+
+  def spend(self, reserved, epochs):
+    """A trial that reserved epochs finished after training epochs"""
+
+    self.reserved = self.reserved - reserved
+    self.used = self.used + epochs
+
+def from_config(cfg, section='search'):
+  """Budget keyword arguments (time_budget in seconds and/or
+  epoch_budget) for the limits given in a config section"""
+
+  budgets = {}
+  for option in ('time_budget', 'epoch_budget'):
+    if cfg.has_option(section, option):
+      budgets[option] = cfg.getint(section, option)
+
+  return budgets
+
+class DeadlineStopping(Callback):
+  """Stop training after the batch during which the deadline passes"""
+
+  def __init__(self, deadline):
+    """Deadline as returned by time.time()"""
+
+    super().__init__()
+
+    self.deadline = deadline
+    self.stopped = False
+
+  def on_batch_end(self, batch, logs=None):
+    """Check the clock after every batch"""
+
+    if time.time() >= self.deadline:
+      self.stopped = True
+      self.model.stop_training = True
+
+if __name__ == "__main__":
+
+  print()
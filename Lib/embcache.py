@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import collections, hashlib, os, os.path, tempfile
+import word2vec
+
+MAX_ENTRIES = 4 # selected matrices kept in memory
+
+class EmbeddingCache:
+  """Embedding matrices selected for an alphabet, in memory
+  (least recently used are dropped first) and on disk"""
+
+  def __init__(self,
+               cache_dir=None,
+               max_entries=MAX_ENTRIES,
+               dtype=word2vec.DTYPE):
+    """Also cache on disk in cache_dir unless it's None"""
+
+    self.cache_dir = cache_dir
+    self.max_entries = max_entries
+    self.dtype = dtype # e.g. float16 to keep more matrices
+    self.matrices = collections.OrderedDict() # key to matrix
+
+  def key(self, path, alphabet):
+    """Hash of the model file, dtype and the alphabet"""
+
+    stat = os.stat(path)
+    md5 = hashlib.md5()
+    md5.update(repr((os.path.abspath(path),
+                     stat.st_size,
+                     stat.st_mtime_ns,
+                     np.dtype(self.dtype).str)).encode('utf-8'))
+    for token, index in sorted(alphabet.items(), key=lambda item: item[1]):
+      md5.update(('%s\t%d\n' % (token, index)).encode('utf-8'))
+
+    return md5.hexdigest()
+
+  def load_vectors(self, path, alphabet):
+    """Same as word2vec.load_vectors() but cached; the
+    matrix is shared between callers so don't modify it"""
+
+    key = self.key(path, alphabet)
+    if key in self.matrices:
+      self.matrices.move_to_end(key)
+      return self.matrices[key]
+
+    cache_path = None
+    if self.cache_dir != None:
+      cache_path = os.path.join(self.cache_dir, key + '.npy')
+
+    if cache_path != None and os.path.isfile(cache_path):
+      matrix = np.load(cache_path)
+    else:
+      matrix = word2vec.load_vectors(path, alphabet, dtype=self.dtype)
+      if cache_path != None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # unique temp name: workers may miss the cache at the same time
+        fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=self.cache_dir)
+        try:
+          with os.fdopen(fd, 'wb') as file:
+            np.save(file, matrix)
+          os.replace(tmp_path, cache_path)
+        except BaseException:
+          os.remove(tmp_path)
+          raise
+
+    self.matrices[key] = matrix
+    if len(self.matrices) > self.max_entries:
+      self.matrices.popitem(last=False)
+
+    return matrix
+
+# one cache per directory and dtype shared by everything in a process
+caches = {}
+
+def load_vectors(path, alphabet, cache_dir=None, dtype=word2vec.DTYPE):
+  """Vectors for alphabet from the process-wide cache"""
+
+  key = (cache_dir, np.dtype(dtype).str)
+  if key not in caches:
+    caches[key] = EmbeddingCache(cache_dir, dtype=dtype)
+
+  return caches[key].load_vectors(path, alphabet)
+
+if __name__ == "__main__":
+
+  print()
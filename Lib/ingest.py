@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import collections, multiprocessing, os
+
+def read_shard(read_file, files):
+  """Tokenize a shard of files; ids are local to the shard"""
+
+  vocab = {}     # token to shard id in order of first occurrence
+  shard_ids = [] # one int32 array per file (None if skipped)
+
+  for file in files:
+    tokens = read_file(file)
+    if tokens is None:
+      shard_ids.append(None) # e.g. file too long
+      continue
+    ids = [vocab.setdefault(token, len(vocab)) for token in tokens]
+    shard_ids.append(np.array(ids, dtype=np.int32))
+
+  # insertion order is the order of first occurrence
+  flat = np.concatenate(
+    [np.zeros(0, dtype=np.int32)] + [ids for ids in shard_ids if ids is not None])
+  counts = collections.Counter(
+    dict(zip(vocab, np.bincount(flat, minlength=len(vocab)).tolist())))
+
+  return list(vocab), counts, shard_ids
+
+def _read_shard(args):
+  """Unpack arguments for Pool.imap()"""
+
+  return read_shard(*args)
+
+def read_files(read_file, files, processes=None, shards_per_process=4):
+  """Tokenize files in a process pool and merge shards in order"""
+
+  if processes == None:
+    processes = os.cpu_count()
+
+  # contiguous shards so that merging them in order
+  # is the same as reading the files one after another
+  num_shards = max(1, min(len(files), processes * shards_per_process))
+  shard_size = max(1, -(-len(files) // num_shards))
+  shards = [files[i:i+shard_size] for i in range(0, len(files), shard_size)]
+  tasks = [(read_file, shard) for shard in shards]
+
+  vocab = {}                          # token to id
+  counts = collections.Counter()      # token to count
+  all_ids = []                        # one array per file
+
+  def merge(results):
+    for shard_vocab, shard_counts, shard_ids in results:
+      remap = np.array(
+        [vocab.setdefault(token, len(vocab)) for token in shard_vocab],
+        dtype=np.int32)
+      counts.update(shard_counts)
+      for ids in shard_ids:
+        all_ids.append(None if ids is None else remap[ids])
+
+  if processes == 1 or len(shards) < 2:
+    merge(map(_read_shard, tasks))
+  else:
+    with multiprocessing.Pool(processes) as pool:
+      merge(pool.imap(_read_shard, tasks))
+
+  return list(vocab), counts, all_ids
+
+if __name__ == "__main__":
+
+  print()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+class RaggedArray:
+  """Variable length int sequences as a flat array plus offsets"""
+
+  def __init__(self, values, offsets):
+    """Sequence i is values[offsets[i]:offsets[i+1]]"""
+
+    self.values = values   # int32 tokens of all sequences
+    self.offsets = offsets # int64 array of len(sequences) + 1
+
+  @classmethod
+  def from_sequences(cls, sequences, dtype=np.int32):
+    """Make from a list of lists or arrays"""
+
+    lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    values = np.zeros(offsets[-1], dtype=dtype)
+    for i, seq in enumerate(sequences):
+      values[offsets[i]:offsets[i+1]] = seq
+
+    return cls(values, offsets)
+
+  def __len__(self):
+    """Number of sequences"""
+
+    return len(self.offsets) - 1
+
+  def lengths(self):
+    """Length of each sequence"""
+
+    return np.diff(self.offsets)
+
+  def __getitem__(self, key):
+    """Int key gives a sequence; slices and index arrays a RaggedArray"""
+
+    if isinstance(key, (int, np.integer)):
+      if key < 0:
+        key = key + len(self)
+      return self.values[self.offsets[key]:self.offsets[key+1]]
+
+    if isinstance(key, slice):
+      start, stop, step = key.indices(len(self))
+      if step == 1:
+        # contiguous; no need to copy values
+        offsets = self.offsets[start:stop+1] if stop > start else self.offsets[:1]
+        return RaggedArray(self.values, offsets)
+      key = np.arange(start, stop, step)
+
+    # gather sequences into a new flat array
+    key = np.asarray(key)
+    if key.dtype == bool:
+      key = np.flatnonzero(key)
+    starts = self.offsets[key]
+    lengths = self.offsets[key + 1] - starts
+    offsets = np.zeros(len(key) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    positions = np.arange(offsets[-1], dtype=np.int64) \
+      + np.repeat(starts - offsets[:-1], lengths)
+
+    return RaggedArray(self.values[positions], offsets)
+
+  def pad(self, maxlen=None, value=0, dtype=np.int32):
+    """Same as keras pad_sequences() with pre padding and truncation"""
+
+    lengths = self.lengths()
+    if maxlen == None:
+      maxlen = int(lengths.max()) if len(lengths) > 0 else 0
+
+    # keep the last maxlen tokens, right aligned
+    kept = np.minimum(lengths, maxlen)
+    rows = np.repeat(np.arange(len(self)), kept)
+    first = np.zeros(len(self) + 1, dtype=np.int64)
+    np.cumsum(kept, out=first[1:])
+    within = np.arange(first[-1], dtype=np.int64) - np.repeat(first[:-1], kept)
+    cols = within + np.repeat(maxlen - kept, kept)
+    source = within + np.repeat(self.offsets[1:] - kept, kept)
+
+    padded = np.full((len(self), maxlen), value, dtype=dtype)
+    padded[rows, cols] = self.values[source]
+
+    return padded
+
+  def tolist(self):
+    """Convert to a list of lists of ints"""
+
+    return [self[i].tolist() for i in range(len(self))]
+
+if __name__ == "__main__":
+
+  print()
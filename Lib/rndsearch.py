@@ -15,11 +15,12 @@ s = tf.Session(graph=tf.get_default_graph())
 bke.set_session(s)
 
 # the rest of imports
-import sys, random, gc, keras
+import sys, random, gc, keras, multiprocessing, concurrent.futures
 sys.path.append('../Lib/')
 sys.dont_write_bytecode = True
+import trialstore, sharedmem, telemetry, budget
 from sklearn.metrics import f1_score
-from keras.callbacks import EarlyStopping
+from keras.callbacks import EarlyStopping, Callback
 from sklearn.model_selection import train_test_split
 
 # ignore sklearn warnings
@@ -43,6 +44,296 @@ def sample(params):
 
   return config
 
+class RandomSampler:
+  """Samples each configuration independently"""
+
+  def __init__(self, params):
+    """Sample from param space"""
+
+    self.params = params
+
+  def sample(self):
+    """Next configuration to try"""
+
+    return sample(self.params)
+
+  def tell(self, config, score):
+    """Score of a finished configuration (higher is better)"""
+
+    pass
+
+class TPESampler(RandomSampler):
+  """Tree-structured Parzen estimator: models the density of good and
+  bad values of each hyperparameter (independently) and picks the
+  candidate with the highest ratio of the two"""
+
+  def __init__(self, params, gamma=0.25, startup=10, candidates=24):
+    """Random configurations until startup trials have finished"""
+
+    super().__init__(params)
+
+    self.gamma = gamma           # best fraction of trials are good
+    self.startup = startup       # trials before modeling
+    self.candidates = candidates # drawn from the good densities
+    self.history = []            # (config, score) of finished trials
+
+  def tell(self, config, score):
+    """Score of a finished configuration (higher is better)"""
+
+    self.history.append((config, score))
+
+  def sample(self):
+    """Next configuration to try"""
+
+    if len(self.history) < self.startup:
+      return sample(self.params)
+
+    ranked = sorted(self.history, key=lambda item: item[1], reverse=True)
+    num_good = max(1, int(np.ceil(self.gamma * len(ranked))))
+    good = [config for config, score in ranked[:num_good]]
+    bad = [config for config, score in ranked[num_good:]]
+
+    config = {}
+    for param, value in self.params.items():
+      good_values = [c[param] for c in good if param in c]
+      bad_values = [c[param] for c in bad if param in c]
+      if hasattr(value, 'rvs'):
+        config[param] = self.sample_numeric(value, good_values, bad_values)
+      else:
+        config[param] = self.sample_choice(value, good_values, bad_values)
+
+    return config
+
+  def sample_choice(self, choices, good_values, bad_values):
+    """Pick from a tuple by frequencies in good and bad trials"""
+
+    def weights(values):
+      counts = np.array([values.count(choice) for choice in choices])
+      return (counts + 1.0) / (len(values) + len(choices)) # add one
+
+    good = weights(good_values)
+    bad = weights(bad_values)
+    drawn = np.random.choice(len(choices), size=self.candidates, p=good)
+    best = drawn[np.argmax(np.log(good[drawn]) - np.log(bad[drawn]))]
+
+    return choices[best]
+
+  def sample_numeric(self, dist, good_values, bad_values):
+    """Sample a scipy.stats distribution via parzen estimators"""
+
+    discrete = hasattr(dist.dist, 'pmf')
+    low, high = dist.support()
+    values = good_values + bad_values
+    if np.isfinite(low) and np.isfinite(high):
+      spread = high - low
+    else:
+      spread = np.std(values) if np.std(values) > 0 else 1.0
+
+    def density(x, centers):
+      # prior plus a gaussian at every observed value
+      sigma = spread * (len(centers) + 1) ** -0.2 / 2
+      prior = dist.pmf(x) if discrete else dist.pdf(x)
+      kernels = np.exp(-0.5 * ((x[:, None] - np.array(centers)[None, :]) / sigma) ** 2) \
+        / (sigma * np.sqrt(2 * np.pi))
+      return (prior + kernels.sum(axis=1)) / (len(centers) + 1)
+
+    # draw candidates from the good density
+    sigma = spread * (len(good_values) + 1) ** -0.2 / 2
+    component = np.random.randint(-1, len(good_values), size=self.candidates)
+    centers = np.array(good_values + [0.0])[component]
+    candidates = np.where(
+      component < 0,
+      dist.rvs(size=self.candidates),
+      centers + np.random.normal(0, sigma, size=self.candidates))
+    candidates = np.clip(candidates, low, high)
+    if discrete:
+      candidates = np.round(candidates)
+
+    ratio = np.log(density(candidates, good_values) + 1e-12) \
+      - np.log(density(candidates, bad_values) + 1e-12)
+    best = candidates[np.argmax(ratio)]
+
+    return int(best) if discrete else best
+
+class MedianPruner(Callback):
+  """Stop a trial whose val_loss after an epoch is worse than the
+  median of finished trials after the same epoch"""
+
+  def __init__(self, curves, min_trials=5, warmup=1):
+    """Curves are val_loss per epoch of finished trials"""
+
+    super().__init__()
+
+    self.curves = curves
+    self.min_trials = min_trials # finished trials needed to prune
+    self.warmup = warmup         # epochs that are never pruned
+    self.pruned = False
+
+  def on_epoch_end(self, epoch, logs=None):
+    """Compare with other trials after this epoch"""
+
+    if epoch < self.warmup:
+      return
+
+    # no val_loss if the epoch was cut short at the deadline
+    loss = logs.get('val_loss') if logs != None else None
+    if loss == None:
+      return
+
+    losses = [curve[epoch] for curve in self.curves if len(curve) > epoch]
+    if len(losses) >= self.min_trials and loss > np.median(losses):
+      self.pruned = True
+      self.model.stop_training = True
+
+def run_trial(
+  make_model,  # function that returns a keras model
+  fixed_args,  # make_model and other fixed arguments
+  config,      # sampled hyperparameters
+  x_train,     # training examples
+  y_train,     # training labels
+  x_val,       # validation examples
+  y_val,       # validation labels
+  curves=None, # prune against these if not None
+  deadline=None, # abort training at this time
+  max_epochs=None): # fewer epochs than args['epochs']
+  """Train and evaluate one configuration; returns config with
+  the effective number of epochs added, the score, val_loss
+  after each epoch, whether the trial was pruned and whether
+  it was aborted at the deadline (then the score is None)"""
+
+  args = config.copy()
+  args.update(fixed_args)
+
+  model = make_model(args)
+
+  erstop = EarlyStopping(
+    monitor='val_loss',
+    min_delta=0,
+    patience=2,
+    restore_best_weights=True)
+
+  optim = getattr(keras.optimizers, args['optimizer'])
+  model.compile(
+    loss=args['loss'],
+    optimizer=optim(lr=10**args['log10lr']),
+    metrics=['accuracy'])
+
+  callbacks = [erstop]
+  if curves is not None:
+    pruner = MedianPruner(curves)
+    callbacks.append(pruner)
+  if deadline is not None:
+    stopper = budget.DeadlineStopping(deadline)
+    callbacks.append(stopper)
+
+  history = model.fit(
+    x_train,
+    y_train,
+    validation_data=(x_val, y_val),
+    epochs=args['epochs'] if max_epochs is None else min(args['epochs'], max_epochs),
+    batch_size=args['batch'],
+    verbose=0,
+    callbacks=callbacks)
+  curve = [float(loss) for loss in history.history.get('val_loss', [])]
+
+  pruned = curves is not None and pruner.pruned
+  if deadline is not None and stopper.stopped:
+    return config, None, curve, pruned, True
+
+  # add effective number of epochs to config
+  config = config.copy()
+  if erstop.stopped_epoch > 0:
+    config['epochs'] = erstop.stopped_epoch - 1
+  else:
+    config['epochs'] = 0
+
+  predictions = model.predict_classes(x_val)
+  f1 = f1_score(y_val, predictions, average='macro')
+
+  return config, f1, curve, pruned, False
+
+def trial_epochs(fixed_args, config):
+  """Most epochs a trial can train for"""
+
+  args = config.copy()
+  args.update(fixed_args)
+
+  return args['epochs']
+
+# set in each worker process by init_worker()
+worker_args = None
+worker_threads = None
+
+def set_worker_session(threads):
+  """Keras session with capped thread pools"""
+
+  session_config = tf.ConfigProto(
+    intra_op_parallelism_threads=threads,
+    inter_op_parallelism_threads=threads)
+  bke.set_session(tf.Session(graph=tf.get_default_graph(), config=session_config))
+
+def init_worker(threads, make_model, fixed_args, x_train, y_train, x_val, y_val):
+  """Own session with capped thread pools; arrays arrive as
+  sharedmem handles and are mapped rather than copied"""
+
+  global worker_args, worker_threads
+
+  worker_threads = threads
+  set_worker_session(threads)
+
+  worker_args = sharedmem.attach(
+    (make_model, fixed_args, x_train, y_train, x_val, y_val))
+
+def run_worker_trial(task):
+  """Run trial i in a worker process; also returns its telemetry"""
+
+  i, config, curves, deadline, max_epochs = task
+  make_model, fixed_args, x_train, y_train, x_val, y_val = worker_args
+
+  # prevent OOM errors; clear_session() drops the capped
+  # session and keras would default to one using all cores
+  gc.collect()
+  bke.clear_session()
+  set_worker_session(worker_threads)
+
+  meter = telemetry.Meter()
+  config, f1, curve, pruned, aborted = run_trial(
+    make_model,
+    fixed_args,
+    config,
+    x_train,
+    y_train,
+    x_val,
+    y_val,
+    curves,
+    deadline,
+    max_epochs)
+
+  return i, config, f1, curve, pruned, meter.stats(len(x_train), len(curve)), aborted
+
+def options_from_config(cfg, param_space, section='search'):
+  """Keyword arguments of run() set in a config section:
+  processes, sampler = tpe, prune, the budgets and shared_dir"""
+
+  options = budget.from_config(cfg, section)
+
+  # trials trained in parallel
+  options['processes'] = 1
+  if cfg.has_option(section, 'processes'):
+    options['processes'] = cfg.getint(section, 'processes')
+
+  # model-based sampling and median pruning
+  options['sampler'] = None
+  if cfg.has_option(section, 'sampler') and cfg.get(section, 'sampler') == 'tpe':
+    options['sampler'] = TPESampler(param_space)
+  options['prune'] = cfg.has_option(section, 'prune') and cfg.getboolean(section, 'prune')
+
+  # e.g. when /dev/shm is too small
+  if cfg.has_option(section, 'shared_dir'):
+    options['shared_dir'] = cfg.get(section, 'shared_dir')
+
+  return options
+
 def run(
   make_model,  # function that returns a keras model
   fixed_args,  # make_model and other fixed arguments
@@ -52,63 +343,151 @@ def run(
   x_val=None,  # validation examples
   y_val=None,  # validation labels
   n=100,       # number of iterations
-  verbose=0):  # suppress output
-  """Random search"""
+  verbose=0,   # 1 to print every trial
+  processes=1, # trials trained in parallel
+  threads=None, # tf threads per process
+  trials_file=None, # resume from finished trials
+  sampler=None, # e.g. TPESampler(param_space)
+  prune=False, # stop trials below the median
+  time_budget=None, # seconds before trials are aborted
+  epoch_budget=None, # total epochs of all trials
+  shared_dir=None): # for the arrays workers map
+  """Random search; stops early when a budget runs out (the
+  last trial gets the epochs that are left; trials aborted at
+  the deadline are neither scored nor stored)"""
+
+  if sampler == None:
+    sampler = RandomSampler(param_space)
+  search_budget = budget.Budget(time_budget, epoch_budget)
 
   # need a validation set?
-  if x_val == None:
+  if x_val is None:
     x_train, x_val, y_train, y_val = \
       train_test_split(x_train, y_train, test_size=0.2)
 
   # configurations and their scores
   config2score = {}
 
-  for i in range(n):
-
-    # prevent OOM errors
-    gc.collect()
-    bke.clear_session()
-
-    config = sample(param_space)
-    args = config.copy()
-    args.update(fixed_args)
-
-    model = make_model(args)
-
-    erstop = EarlyStopping(
-      monitor='val_loss',
-      min_delta=0,
-      patience=2,
-      restore_best_weights=True)
-
-    optim = getattr(keras.optimizers, args['optimizer'])
-    model.compile(
-      loss=args['loss'],
-      optimizer=optim(lr=10**args['log10lr']),
-      metrics=['accuracy'])
-
-    model.fit(
-      x_train,
-      y_train,
-      validation_data=(x_val, y_val),
-      epochs=args['epochs'],
-      batch_size=args['batch'],
-      verbose=0,
-      callbacks=[erstop])
-
-    # add effective number of epochs to config
-    if erstop.stopped_epoch > 0:
-      config['epochs'] = erstop.stopped_epoch - 1
-    else:
-      config['epochs'] = 0
+  # trials of the same search that finished before
+  store = trialstore.TrialStore(trials_file, trialstore.make_spec(
+    'rndsearch',
+    make_model.__name__,
+    trialstore.describe(param_space),
+    trialstore.describe(fixed_args),
+    trialstore.data_digest(x_train, y_train, x_val, y_val)))
+  curves = [] # val_loss per epoch of finished trials
+  done = set()
+  for record in store.records:
+    if record['trial'] < n:
+      config2score[tuple(record['config'].items())] = record['score']
+      sampler.tell(record['config'], record['score'])
+      curves.append(record.get('curve', []))
+      done.add(record['trial'])
 
-    predictions = model.predict_classes(x_val)
-    f1 = f1_score(y_val, predictions, average='macro')
+  def report(i, config, f1, curve, pruned, stats):
     config2score[tuple(config.items())] = f1
-
+    sampler.tell(config, f1)
+    curves.append(curve)
+    store.add(
+      trial=i,
+      config=config,
+      score=f1,
+      epochs=config['epochs'],
+      curve=curve,
+      pruned=pruned,
+      **stats)
     if verbose == 1:
       print('[%d] %s' % (i + 1, config))
-      print('[%d] score: %.3f' % (i + 1, f1))
+      print('[%d] score: %.3f, %d epochs in %.1fs, %.1f samples/s, %.1f MB peak' % (
+        i + 1, f1, stats['epochs_run'], stats['seconds'],
+        stats['samples_per_sec'], stats['peak_rss_mb']))
+
+  if processes == 1:
+    for i in range(n):
+      config = sampler.sample() # even if done; same samples as before
+      if i in done:
+        continue
+
+      epochs = search_budget.reserve(trial_epochs(fixed_args, config), partial=True)
+      if epochs == 0:
+        print('search budget exhausted after %d trials' % len(config2score))
+        break
+
+      # prevent OOM errors
+      gc.collect()
+      bke.clear_session()
+
+      meter = telemetry.Meter()
+      config, f1, curve, pruned, aborted = run_trial(
+        make_model,
+        fixed_args,
+        config,
+        x_train,
+        y_train,
+        x_val,
+        y_val,
+        curves if prune else None,
+        search_budget.deadline,
+        epochs)
+      stats = meter.stats(len(x_train), len(curve))
+      search_budget.spend(epochs, stats['epochs_run'])
+      if aborted:
+        print('[%d] aborted at the deadline' % (i + 1))
+        break
+      report(i, config, f1, curve, pruned, stats)
+  else:
+    # workers are spawned; forking would share our tf session
+    if processes == None:
+      processes = os.cpu_count()
+    if threads == None:
+      threads = max(1, os.cpu_count() // processes)
+
+    todo = [i for i in range(n) if i not in done]
+    context = multiprocessing.get_context('spawn')
+    with sharedmem.SharedArrays(shared_dir) as arrays, \
+         concurrent.futures.ProcessPoolExecutor(
+           processes,
+           mp_context=context,
+           initializer=init_worker,
+           initargs=arrays.share(
+             (threads, make_model, fixed_args, x_train, y_train, x_val, y_val))) as pool:
+
+      # sample when a worker is free so that the sampler
+      # and the pruner know about all finished trials
+      running = {} # future -> reserved epochs
+      pending = None # sampled trial waiting for budget
+      while True:
+        while len(todo) > 0 and len(running) < processes:
+          if pending == None:
+            pending = (todo[0], sampler.sample())
+          # fewer epochs only for the last trial; running
+          # trials may still give back the ones they reserved
+          epochs = search_budget.reserve(
+            trial_epochs(fixed_args, pending[1]),
+            partial=len(running) == 0)
+          if epochs == 0:
+            break
+          todo.pop(0)
+          task = pending + (list(curves) if prune else None, search_budget.deadline, epochs)
+          running[pool.submit(run_worker_trial, task)] = epochs
+          pending = None
+        if len(running) == 0:
+          break
+        finished, _ = concurrent.futures.wait(
+          running,
+          return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in finished:
+          i, config, f1, curve, pruned, stats, aborted = future.result()
+          search_budget.spend(running.pop(future), stats['epochs_run'])
+          if aborted:
+            print('[%d] aborted at the deadline' % (i + 1))
+          else:
+            report(i, config, f1, curve, pruned, stats)
+      if len(todo) > 0:
+        print('search budget exhausted after %d trials' % len(config2score))
+
+  print('\ntrials sorted by score:')
+  print(telemetry.summary([r for r in store.records if r['trial'] < n]))
 
   return config2score
 
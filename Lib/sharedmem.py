@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import os, os.path, shutil, tempfile
+
+# tmpfs is shared memory on linux; other systems use the temp dir
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+def free_bytes(path):
+  """Space left on the file system of path (None if unknown)"""
+
+  if not hasattr(os, 'statvfs'):
+    return None
+  stats = os.statvfs(path)
+  return stats.f_bavail * stats.f_frsize
+
+def nbytes(value):
+  """Size of the ndarrays share() would write for value"""
+
+  if isinstance(value, np.ndarray):
+    return value.nbytes
+  if isinstance(value, (list, tuple)):
+    return sum(nbytes(element) for element in value)
+  if isinstance(value, dict):
+    return sum(nbytes(element) for element in value.values())
+
+  return 0
+
+class ArrayHandle:
+  """Picklable reference to an array saved as .npy; processes
+  map the file instead of receiving a copy of the data"""
+
+  def __init__(self, path, shape, dtype):
+    """Array stored in path"""
+
+    self.path = path
+    self.shape = shape
+    self.dtype = dtype
+
+  def attach(self):
+    """Read-only view of the array backed by the file"""
+
+    return np.load(self.path, mmap_mode='r')
+
+class SharedArrays:
+  """Arrays handed to worker processes by reference; the files
+  are removed on close() (or when leaving a with block)"""
+
+  def __init__(self, shared_dir=None):
+    """Create a fresh directory under shared_dir (SHARED_DIR
+    if None)"""
+
+    if shared_dir == None:
+      shared_dir = SHARED_DIR
+
+    self.dir = tempfile.mkdtemp(prefix='arrays', dir=shared_dir)
+    self.dirs = [self.dir] # removed by close()
+    self.count = 0 # arrays written so far
+
+  def share(self, value):
+    """Handle for an ndarray; lists, tuples and dicts are
+    shared element by element; other values are unchanged.
+    The arrays go to the temp dir if they don't fit (e.g.
+    docker's /dev/shm is 64MB by default)"""
+
+    free = free_bytes(self.dir)
+    if free != None and free < nbytes(value):
+      self.dir = tempfile.mkdtemp(prefix='arrays', dir=tempfile.gettempdir())
+      self.dirs.append(self.dir)
+
+    return self.share_all(value)
+
+  def share_all(self, value):
+    """share() without the space check"""
+
+    if isinstance(value, np.ndarray):
+      path = os.path.join(self.dir, '%d.npy' % self.count)
+      self.count = self.count + 1
+      np.save(path, value)
+      return ArrayHandle(path, value.shape, value.dtype)
+    if isinstance(value, (list, tuple)):
+      return type(value)(self.share_all(element) for element in value)
+    if isinstance(value, dict):
+      return dict((key, self.share_all(element)) for key, element in value.items())
+
+    return value
+
+  def close(self):
+    """Remove the files; mapped arrays stay valid on posix"""
+
+    for path in self.dirs:
+      shutil.rmtree(path, ignore_errors=True)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+def attach(value):
+  """Inverse of SharedArrays.share() in a worker process"""
+
+  if isinstance(value, ArrayHandle):
+    return value.attach()
+  if isinstance(value, (list, tuple)):
+    return type(value)(attach(element) for element in value)
+  if isinstance(value, dict):
+    return dict((key, attach(element)) for key, element in value.items())
+
+  return value
+
+if __name__ == "__main__":
+
+  print()
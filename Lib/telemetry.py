@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import resource, sys, time
+
+# columns of the summary table: record field, heading, format
+COLUMNS = [
+  ('epochs_run', 'epochs', '%6s'),
+  ('seconds', 'seconds', '%9s'),
+  ('samples_per_sec', 'samples/s', '%10s'),
+  ('peak_rss_mb', 'rss MB', '%8s')]
+
+def reset_peak_rss():
+  """Measure peak memory from now on (linux only)"""
+
+  try:
+    with open('/proc/self/clear_refs', 'w') as file:
+      file.write('5')
+  except OSError:
+    pass # peak since the process started
+
+def peak_rss():
+  """Peak resident memory of this process in bytes"""
+
+  try:
+    with open('/proc/self/status') as file:
+      for line in file:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+
+  # kilobytes on linux, bytes on macos
+  max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+class Meter:
+  """Wall time, throughput and peak memory of one trial"""
+
+  def __init__(self):
+    """Start measuring"""
+
+    reset_peak_rss()
+    self.start = time.time()
+
+  def stats(self, samples, epochs):
+    """Fields of a trial record; epochs actually trained
+    on a training set of this many samples"""
+
+    seconds = time.time() - self.start
+
+    return {
+      'seconds': seconds,
+      'epochs_run': epochs,
+      'samples_per_sec': samples * epochs / seconds if seconds > 0 else 0.0,
+      'peak_rss_mb': peak_rss() / 2**20}
+
+def summary(records, score='score', reverse=True):
+  """Table of trial records, best score first (lowest
+  if not reverse); records without a field show '-'"""
+
+  def cell(value, width):
+    if value == None:
+      return width % '-'
+    if isinstance(value, float):
+      return width % ('%.1f' % value)
+    return width % value
+
+  heading = ' '.join(['%8s' % score] + [width % name for field, name, width in COLUMNS])
+  lines = [heading + ' config']
+
+  ranked = sorted(records, key=lambda record: record[score], reverse=reverse)
+  for record in ranked:
+    cells = ['%8.3f' % record[score]]
+    cells.extend(cell(record.get(field), width) for field, name, width in COLUMNS)
+    lines.append(' '.join(cells) + ' ' + str(record['config']))
+
+  return '\n'.join(lines)
+
+if __name__ == "__main__":
+
+  print()
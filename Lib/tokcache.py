@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import os, os.path, pickle, tempfile
+
+MANIFEST_FILE = 'manifest.p'
+TOKENS_PREFIX = 'tokens-' # each save writes a new file the manifest names
+CACHE_VERSION = 2
+
+class TokenCache:
+  """Tokenized corpus files stored as int32 ids"""
+
+  def __init__(self, cache_dir=None):
+    """Load cache from cache_dir; in-memory only if None"""
+
+    self.cache_dir = cache_dir
+    self.vocab = []      # cache id to token
+    self.token2id = {}   # token to cache id
+    self.entries = {}    # path to [size, mtime, limit, start, length]
+    self.tokens = np.zeros(0, dtype=np.int32) # ids of all files
+    self.pending = {}    # path to ids not yet written to disk
+    self.dirty = False   # anything to save?
+    self.tokens_file = None # file self.tokens was loaded from
+
+    if cache_dir == None:
+      return
+
+    manifest_path = os.path.join(cache_dir, MANIFEST_FILE)
+    if not os.path.isfile(manifest_path):
+      return
+
+    manifest = pickle.load(open(manifest_path, 'rb'))
+    if manifest['version'] != CACHE_VERSION:
+      return # stale format; rebuild from scratch
+
+    # the tokens file may be gone if another process saved since
+    try:
+      tokens = np.load(
+        os.path.join(cache_dir, manifest['tokens_file']),
+        mmap_mode='r')
+    except (OSError, ValueError):
+      return
+    if len(tokens) != manifest['num_tokens']:
+      return # not the file this manifest was written for
+
+    self.vocab = manifest['vocab']
+    self.token2id = dict((token, i) for i, token in enumerate(self.vocab))
+    self.entries = manifest['entries']
+    self.tokens = tokens
+    self.tokens_file = manifest['tokens_file']
+
+  def is_fresh(self, path, max_tokens):
+    """Can the cached entry for this file be used?"""
+
+    if path not in self.entries:
+      return False
+
+    stat = os.stat(path)
+    size, mtime, limit, start, length = self.entries[path]
+    if size != stat.st_size or mtime != stat.st_mtime_ns:
+      return False # file changed since it was cached
+
+    # rejected files were only counted up to their limit
+    if length == None and max_tokens > limit:
+      return False
+
+    return True
+
+  def get(self, path, max_tokens):
+    """Return cached ids or None if file has too many tokens"""
+
+    size, mtime, limit, start, length = self.entries[path]
+    if length == None or length > max_tokens:
+      return None
+    if path in self.pending:
+      return self.pending[path]
+
+    return self.tokens[start:start+length]
+
+  def max_bytes_per_token(self):
+    """Largest file size per token of accepted files or None"""
+
+    ratios = [float(size) / length
+              for size, mtime, limit, start, length in self.entries.values()
+              if length != None and length > 0]
+
+    return max(ratios) if len(ratios) > 0 else None
+
+  def add_tokens(self, tokens):
+    """Return cache ids for tokens, adding new ones"""
+
+    ids = []
+    for token in tokens:
+      if token not in self.token2id:
+        self.token2id[token] = len(self.vocab)
+        self.vocab.append(token)
+      ids.append(self.token2id[token])
+
+    return np.array(ids, dtype=np.int32)
+
+  def put(self, path, ids, max_tokens):
+    """Add file as cache ids (or None if too long) to cache"""
+
+    stat = os.stat(path)
+    if ids is None:
+      self.entries[path] = [stat.st_size, stat.st_mtime_ns, max_tokens, 0, None]
+    else:
+      self.entries[path] = [stat.st_size, stat.st_mtime_ns, max_tokens, 0, len(ids)]
+      self.pending[path] = ids
+
+    self.dirty = True
+
+  def save(self):
+    """Write cache to disk if anything changed"""
+
+    if self.cache_dir == None or not self.dirty:
+      return
+    if not os.path.isdir(self.cache_dir):
+      os.makedirs(self.cache_dir)
+
+    # rewrite all ids as a single flat array
+    chunks = []
+    start = 0
+    for path, entry in self.entries.items():
+      if entry[4] == None:
+        continue # rejected file; nothing to store
+      if path in self.pending:
+        ids = self.pending[path]
+      else:
+        ids = self.tokens[entry[3]:entry[3]+entry[4]]
+      chunks.append(ids)
+      entry[3] = start
+      start = start + len(ids)
+
+    tokens = np.concatenate([np.zeros(0, dtype=np.int32)] + chunks)
+
+    # tokens go to a new file and the manifest that names it
+    # is replaced last, so a crash (or another process saving
+    # the same cache) never pairs a manifest with other tokens
+    fd, tokens_path = tempfile.mkstemp(
+      prefix=TOKENS_PREFIX,
+      suffix='.npy',
+      dir=self.cache_dir)
+    with os.fdopen(fd, 'wb') as tokens_file:
+      np.save(tokens_file, tokens)
+
+    manifest = {
+      'version': CACHE_VERSION,
+      'vocab': self.vocab,
+      'entries': self.entries,
+      'tokens_file': os.path.basename(tokens_path),
+      'num_tokens': len(tokens)}
+    fd, manifest_tmp = tempfile.mkstemp(dir=self.cache_dir)
+    with os.fdopen(fd, 'wb') as manifest_file:
+      pickle.dump(manifest, manifest_file)
+    os.replace(manifest_tmp, os.path.join(self.cache_dir, MANIFEST_FILE))
+
+    # old tokens stay valid where they are mmapped (posix)
+    if self.tokens_file != None:
+      try:
+        os.remove(os.path.join(self.cache_dir, self.tokens_file))
+      except OSError:
+        pass # already removed by another process
+
+    self.tokens = tokens
+    self.tokens_file = manifest['tokens_file']
+    self.pending = {}
+    self.dirty = False
+
+if __name__ == "__main__":
+
+  print()
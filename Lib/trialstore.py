@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import hashlib, json, os, os.path
+
+def to_json(value):
+  """Numpy scalars as plain python values"""
+
+  if isinstance(value, np.generic):
+    return value.item()
+
+  raise TypeError('%r is not json serializable' % (value,))
+
+def describe(params):
+  """Hyperparameter space or fixed args without large values"""
+
+  description = []
+  for name, value in sorted(params.items()):
+    if hasattr(value, 'rvs'):
+      # frozen scipy.stats distribution
+      value = (value.dist.name, value.args, sorted(value.kwds.items()))
+    elif not isinstance(value, (int, float, str, bool, tuple, type(None))):
+      continue # e.g. init_vectors
+    description.append((name, value))
+
+  return description
+
+def data_digest(*arrays):
+  """Hash of the data a search runs on"""
+
+  md5 = hashlib.md5()
+  for array in arrays:
+    array = np.ascontiguousarray(array)
+    md5.update(repr((array.shape, array.dtype.str)).encode('utf-8'))
+    md5.update(array.data)
+
+  return md5.hexdigest()
+
+def make_spec(*parts):
+  """Hash that identifies a search; records of others are ignored"""
+
+  return hashlib.md5(repr(parts).encode('utf-8')).hexdigest()
+
+class TrialStore:
+  """Finished trials as json lines so that a search can resume"""
+
+  def __init__(self, path, spec):
+    """Load records of search spec from path (in memory if None)"""
+
+    self.path = path
+    self.spec = spec
+    self.records = [] # this search's records in file order
+
+    if path == None or not os.path.isfile(path):
+      return
+
+    with open(path) as file:
+      for line in file:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          continue # partial line left by a crash
+        if record.get('spec') == spec:
+          self.records.append(record)
+
+  def find(self, **fields):
+    """First record with these fields or None"""
+
+    for record in self.records:
+      if all(record.get(name) == value for name, value in fields.items()):
+        return record
+
+    return None
+
+  def add(self, **fields):
+    """Append record as soon as a trial finishes"""
+
+    record = {'spec': self.spec}
+    record.update(fields)
+    self.records.append(record)
+
+    if self.path == None:
+      return record
+
+    dir_name = os.path.dirname(self.path)
+    if dir_name != '' and not os.path.isdir(dir_name):
+      os.makedirs(dir_name)
+    with open(self.path, 'a') as file:
+      file.write(json.dumps(record, default=to_json) + '\n')
+      file.flush()
+      os.fsync(file.fileno())
+
+    return record
+
+if __name__ == "__main__":
+
+  print()
@@ -1,6 +1,28 @@
 import numpy as np
 import os, os.path
 
+CHUNK_SIZE = 1 << 20 # characters read at a time
+
+def read_token_chunks(file_path, lower=False, chunk_size=CHUNK_SIZE):
+  """Yield whitespace separated tokens one chunk of file at a time"""
+
+  rest = '' # token that may continue in the next chunk
+  with open(file_path) as infile:
+    while True:
+      chunk = infile.read(chunk_size)
+      if not chunk:
+        break
+      if lower:
+        chunk = chunk.lower()
+      tokens = (rest + chunk).split()
+      rest = ''
+      if len(tokens) > 0 and not chunk[-1].isspace():
+        rest = tokens.pop()
+      yield tokens
+
+  if rest:
+    yield [rest]
+
 def read_tokens(file_path):
   """Return file as a list of ngrams"""
 
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import bisect, collections.abc, mmap, pickle, struct
+
+# file layout (little endian):
+#   header: magic, version, number of tokens, size of string blob
+#   counts: int64[n] in sorted token order
+#   offsets: int64[n+1] into string blob
+#   ids: int32[n] alphabet index of each sorted token
+#   blob: utf-8 tokens sorted by their bytes
+MAGIC = b'PHVOCAB\0'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQ')
+
+def write_vocab(path, token2int, token_counts=None):
+  """Write alphabet (token -> int) and optional counts to path"""
+
+  encoded = sorted((token.encode('utf-8'), index)
+                   for token, index in token2int.items())
+  n = len(encoded)
+
+  counts = np.zeros(n, dtype='<i8')
+  if token_counts != None:
+    for i, (token, index) in enumerate(encoded):
+      counts[i] = token_counts.get(token.decode('utf-8'), 0)
+
+  lengths = np.array([len(token) for token, index in encoded], dtype='<i8')
+  offsets = np.zeros(n + 1, dtype='<i8')
+  np.cumsum(lengths, out=offsets[1:])
+  ids = np.array([index for token, index in encoded], dtype='<i4')
+  blob = b''.join(token for token, index in encoded)
+
+  with open(path, 'wb') as outfile:
+    outfile.write(HEADER.pack(MAGIC, VERSION, n, len(blob)))
+    outfile.write(counts.tobytes())
+    outfile.write(offsets.tobytes())
+    outfile.write(ids.tobytes())
+    outfile.write(blob)
+
+def is_vocab_file(path):
+  """Is this a binary vocabulary (and not e.g. a pickle)?"""
+
+  with open(path, 'rb') as infile:
+    return infile.read(len(MAGIC)) == MAGIC
+
+def as_dict(alphabet):
+  """Plain dict for bulk lookups (a Vocabulary is materialized)"""
+
+  if isinstance(alphabet, Vocabulary):
+    return alphabet.materialize()
+
+  return alphabet
+
+def load_alphabet(path):
+  """Open binary vocabulary or unpickle a legacy token2int dict"""
+
+  if is_vocab_file(path):
+    return Vocabulary(path)
+
+  return pickle.load(open(path, 'rb'))
+
+class SortedTokens(collections.abc.Sequence):
+  """Tokens (as bytes) in sorted order for bisect"""
+
+  def __init__(self, mm, start, offsets):
+    """Tokens are stored in mm starting at byte start"""
+
+    self.mm = mm
+    self.start = start
+    self.offsets = offsets
+
+  def __len__(self):
+    """Number of tokens"""
+
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    """Token at sorted position i"""
+
+    return self.mm[self.start+self.offsets[i]:self.start+self.offsets[i+1]]
+
+class Vocabulary(collections.abc.Mapping):
+  """Memory-mapped alphabet that behaves like a token2int dict"""
+
+  def __init__(self, path):
+    """Map vocabulary file; nothing is parsed up front"""
+
+    self.path = path
+    self.file = open(path, 'rb')
+    self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, n, blob_size = HEADER.unpack_from(self.mm, 0)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError('%s: not a version %d vocabulary' % (path, VERSION))
+
+    offset = HEADER.size
+    self.counts = np.frombuffer(self.mm, '<i8', n, offset)
+    offset = offset + 8 * n
+    self.offsets = np.frombuffer(self.mm, '<i8', n + 1, offset)
+    offset = offset + 8 * (n + 1)
+    self.ids = np.frombuffer(self.mm, '<i4', n, offset)
+    offset = offset + 4 * n
+
+    self.tokens = SortedTokens(self.mm, offset, self.offsets)
+    self.token2int = None # materialized on demand
+
+  def position(self, token):
+    """Position of token in sorted order or -1"""
+
+    key = token.encode('utf-8')
+    i = bisect.bisect_left(self.tokens, key)
+    if i < len(self.tokens) and self.tokens[i] == key:
+      return i
+
+    return -1
+
+  def __getitem__(self, token):
+    """Alphabet index of token"""
+
+    if self.token2int != None:
+      return self.token2int[token]
+
+    i = self.position(token)
+    if i < 0:
+      raise KeyError(token)
+
+    return int(self.ids[i])
+
+  def __contains__(self, token):
+    """Binary search unless materialized"""
+
+    if self.token2int != None:
+      return token in self.token2int
+
+    return self.position(token) >= 0
+
+  def __len__(self):
+    """Alphabet size"""
+
+    return len(self.ids)
+
+  def __iter__(self):
+    """Tokens in order of their alphabet index"""
+
+    for i in np.argsort(self.ids, kind='stable'):
+      yield self.tokens[i].decode('utf-8')
+
+  def count(self, token):
+    """Corpus frequency of token (0 if unknown)"""
+
+    i = self.position(token)
+
+    return int(self.counts[i]) if i >= 0 else 0
+
+  def materialize(self):
+    """Build a plain dict for many lookups; returns it"""
+
+    if self.token2int == None:
+      start = self.tokens.start
+      blob = self.mm[start:start+int(self.offsets[-1])]
+      offsets = self.offsets.tolist()
+      tokens = [blob[offsets[i]:offsets[i+1]].decode('utf-8')
+                for i in range(len(offsets) - 1)]
+      self.token2int = dict(zip(tokens, self.ids.tolist()))
+
+    return self.token2int
+
+  def __reduce__(self):
+    """Pickle by path; other processes map the same file"""
+
+    return (Vocabulary, (self.path,))
+
+if __name__ == "__main__":
+
+  print()
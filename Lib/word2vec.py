@@ -1,53 +1,285 @@
 import numpy as np
-import os, os.path
+import scipy.sparse
+import mmap, multiprocessing, os, os.path, sys
+import vocab
 
-def write_vectors(alphabet, weights, path):
-  """Write model to file given an alphabet and weights"""
+# binary models are a float32 matrix (.npy) and a vocabulary
+# file (.vocab, see vocab.py) that maps each word to its row
+BINARY_SUFFIX = '.npy'
+VOCAB_SUFFIX = '.vocab'
+DOCUMENT_BATCH = 10000 # documents (or vectors) at a time
+TEXT_SHARD_SIZE = 1 << 26 # bytes of a text model parsed per task
+DTYPE = np.float32 # float16 halves memory again (e.g. for caching)
+
+def write_vectors(alphabet, weights, path, fmt='%.9g'):
+  """Write model to file given an alphabet and weights; path
+  ending in .npy is written in the binary format Model maps"""
 
   # number of words in alphabet must be the same
   # as the number of rows in weights matrix
   # alphabet maps words to integers
   # integers are indicies into weights matrix
 
+  if is_binary(path):
+    np.save(path, np.asarray(weights, dtype=np.float32))
+    vocab.write_vocab(vocab_path(path), alphabet)
+    return
+
+  # text for other word2vec tools; %.9g round trips float32
+  words = list(alphabet.keys())
+  rows = np.array([alphabet[word] for word in words], dtype=np.int64)
+  line_format = '%s ' + ' '.join([fmt] * weights.shape[1]) + '\n'
+
   with open(path, 'w') as outfile:
     outfile.write('%s %s\n' % (len(alphabet), weights.shape[1]))
-    for word, index in list(alphabet.items()):
-      vector = [str(element) for element in weights[index]]
-      vector_as_string = ' '.join(vector)
-      outfile.write('%s %s\n' % (word, vector_as_string))
+    for start in range(0, len(words), DOCUMENT_BATCH):
+      vectors = weights[rows[start:start+DOCUMENT_BATCH]].tolist()
+      outfile.write(''.join(
+        line_format % tuple([word] + vector)
+        for word, vector in zip(words[start:start+DOCUMENT_BATCH], vectors)))
+
+def is_binary(path):
+  """Is this a binary model that can be mmapped?"""
+
+  return path.endswith(BINARY_SUFFIX)
+
+def vocab_path(path):
+  """Vocabulary file that goes with binary model path"""
+
+  return path[:-len(BINARY_SUFFIX)] + VOCAB_SUFFIX
+
+def read_header(line):
+  """Count and dimensions if line is a header or None"""
+
+  elements = line.split()
+  if len(elements) == 2 and elements[0].isdigit() and elements[1].isdigit():
+    return int(elements[0]), int(elements[1])
+
+  return None
+
+def is_google_binary(path):
+  """Is this a google word2vec binary (.bin) file and not text?"""
+
+  with open(path, 'rb') as file:
+    header = read_header(file.readline().decode('utf-8', 'replace'))
+    if header == None:
+      return False # only text models can do without a header
+    line = file.readline(32 * header[1] + 1024) # first vector
+    elements = line.decode('utf-8', 'replace').split()
+
+  try:
+    [float(element) for element in elements[1:]]
+  except ValueError:
+    return True
+
+  return len(elements) <= header[1]
+
+def read_google_records(path, start, count, dimensions, keep=None, dtype=DTYPE):
+  """Yield (words, vectors) batches of a google binary model"""
+
+  size = 4 * dimensions # bytes of a float32 vector
+  words = []
+  vectors = []
+
+  with open(path, 'rb') as file, \
+       mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+    position = start
+    for i in range(count):
+      while mm[position] == ord('\n'):
+        position = position + 1 # some writers end vectors with newline
+      end = mm.find(b' ', position)
+      word = mm[position:end].decode('utf-8', 'replace')
+      position = end + 1 + size
+      if keep != None and word not in keep:
+        continue
+      words.append(word)
+      vectors.append(np.frombuffer(mm[end+1:position], dtype='<f4'))
+      if len(words) == DOCUMENT_BATCH:
+        yield words, np.array(vectors, dtype=dtype)
+        words = []
+        vectors = []
+
+  yield words, np.array(vectors, dtype=dtype).reshape(-1, dimensions)
+
+def text_shards(path, start):
+  """Byte ranges of a text model that begin at line boundaries"""
+
+  size = os.path.getsize(path)
+  bounds = [start]
+  with open(path, 'rb') as file:
+    while True:
+      file.seek(bounds[-1] + TEXT_SHARD_SIZE)
+      file.readline()
+      if file.tell() >= size:
+        break
+      bounds.append(file.tell())
+  bounds.append(size)
+
+  return list(zip(bounds[:-1], bounds[1:]))
+
+def read_text_shard(path, start, end, dimensions, keep=None, dtype=DTYPE):
+  """Parse the lines of a text model between byte offsets"""
+
+  with open(path, 'rb') as file:
+    file.seek(start)
+    text = file.read(end - start).decode('utf-8')
+
+  words = []
+  values = []
+  for line in text.split('\n'):
+    elements = line.split(None, 1)
+    if len(elements) < 2 or (keep != None and elements[0] not in keep):
+      continue
+    words.append(elements[0])
+    values.extend(elements[1].split()[:dimensions])
+
+  return words, np.array(values, dtype=dtype).reshape(-1, dimensions)
+
+def _read_text_shard(args):
+  """Unpack arguments for Pool.imap()"""
+
+  return read_text_shard(*args)
+
+def read_text_records(path,
+                      start,
+                      dimensions,
+                      keep=None,
+                      processes=None,
+                      dtype=DTYPE):
+  """Yield (words, vectors) batches of a text model; shards
+  are parsed in a process pool but yielded in file order"""
+
+  tasks = [(path, begin, end, dimensions, keep, dtype)
+           for begin, end in text_shards(path, start)]
+
+  if processes == 1 or len(tasks) < 2:
+    yield from map(_read_text_shard, tasks)
+  else:
+    with multiprocessing.Pool(processes) as pool:
+      yield from pool.imap(_read_text_shard, tasks)
+
+def read_model(path, keep=None, processes=None, dtype=DTYPE):
+  """Dimensions and an iterator over (words, vectors) batches of a
+  text or google binary model; only words in keep unless it's None"""
+
+  with open(path, 'rb') as file:
+    first = file.readline()
+  header = read_header(first.decode('utf-8', 'replace'))
+
+  if is_google_binary(path):
+    count, dimensions = header
+    return dimensions, read_google_records(
+      path, len(first), count, dimensions, keep, dtype)
+
+  if header == None:
+    # no header; the first line is a vector
+    start, dimensions = 0, len(first.split()) - 1
+  else:
+    start, dimensions = len(first), header[1]
+
+  return dimensions, read_text_records(
+    path, start, dimensions, keep, processes, dtype)
+
+def convert(path, binary_path, verbose=False, processes=None):
+  """One time conversion of a text model to binary format"""
+
+  model = Model(path, verbose, processes)
+  model.save(binary_path)
+
+def load_vectors(path, alphabet, verbose=False, processes=None, dtype=DTYPE):
+  """Same as Model(path).select_vectors(alphabet) but only keeps
+  the rows of alphabet items in memory while reading the model"""
+
+  if is_binary(path):
+    # mapped; only the selected rows are paged in
+    return Model(path, verbose, dtype=dtype).select_vectors(alphabet)
+
+  word2int = dict(alphabet.items())
+  dimensions, batches = read_model(path, word2int, processes, dtype)
+  found = np.zeros(len(word2int), dtype=bool)
+  vecs = np.zeros((len(word2int), dimensions), dtype=dtype)
+
+  # only vectors we need are parsed; last occurrence wins
+  for words, vectors in batches:
+    for word, vector in zip(words, vectors):
+      vecs[word2int[word], :] = vector
+      found[word2int[word]] = True
+
+  # also tried np.random.uniform(low=-0.25, high=0.25, size=dimensions)
+  if found.any():
+    vecs[~found] = vecs[found].mean(axis=0, dtype=np.float64)
+
+  oov_rate = 1 - float(found.sum()) / len(word2int)
+  if verbose:
+    print('embedding oov rate: %s%%' % (round(oov_rate * 100, 2)))
+  return vecs
 
 class Model:
   """Represents a word2vec model"""
 
-  def __init__(self, path, verbose=False):
-    """Initiaize from a word2vec model file"""
+  def __init__(self, path, verbose=False, processes=None, dtype=DTYPE):
+    """Initiaize from a word2vec model file (text, google binary
+    or our own binary format); text is parsed in a process pool"""
 
     self.count = None      # number of vectors
     self.dimensions = None # number of dimensions
-    self.vectors = {}      # key: word, value: numpy vector
+    self.matrix = None     # one vector per row
+    self.word2row = {}     # key: word, value: row in matrix
     self.verbose = verbose # verbosity
+    self.dtype = dtype     # of matrix and returned vectors
 
-    with open(path) as file:
-      for line in file:
-        elements = line.strip().split()
-        if len(elements) < 5: # parse header
-          self.count = int(elements[0])
-          self.dimensions = int(elements[1])
-          continue
-        word = elements[0]
-        vector = [float(element) for element in elements[1:self.dimensions+1]]
-        self.vectors[word] = np.array(vector)
-
-  def select_vectors(self, alphabet):
+    if is_binary(path):
+      self.load_binary(path)
+    else:
+      self.read(path, processes)
+
+  def read(self, path, processes=None):
+    """Parse a text or google binary model"""
+
+    self.dimensions, batches = read_model(
+      path, processes=processes, dtype=self.dtype)
+
+    matrices = [np.zeros((0, self.dimensions), dtype=self.dtype)]
+    rows = 0
+    for words, vectors in batches:
+      for i, word in enumerate(words):
+        self.word2row[word] = rows + i # last occurrence wins
+      matrices.append(vectors)
+      rows = rows + len(words)
+
+    self.matrix = np.concatenate(matrices)
+    self.count = rows
+
+  def load_binary(self, path):
+    """Map a binary model; pages are shared between processes"""
+
+    self.matrix = np.load(path, mmap_mode='r')
+    if self.matrix.dtype != self.dtype:
+      self.matrix = self.matrix.astype(self.dtype) # no longer mapped
+    self.word2row = vocab.Vocabulary(vocab_path(path))
+    self.count, self.dimensions = self.matrix.shape
+
+  def save(self, path):
+    """Write model in binary format"""
+
+    if not is_binary(path):
+      raise ValueError('%s: binary model must end with %s' % (path, BINARY_SUFFIX))
+
+    np.save(path, np.asarray(self.matrix, dtype=np.float32))
+    vocab.write_vocab(vocab_path(path), self.word2row)
+
+  def select_vectors(self, alphabet, dtype=None):
     """Return vectors for items in alphabet"""
 
+    dtype = self.dtype if dtype == None else dtype
     average = self.average_words(list(alphabet.keys()))
-    vecs = np.zeros((len(alphabet), self.dimensions))
+    vecs = np.zeros((len(alphabet), self.dimensions), dtype=dtype)
 
+    word2row = vocab.as_dict(self.word2row) # looked up per word
     oov_count = 0
     for word, index in list(alphabet.items()):
-      if word in self.vectors:
-        vecs[index, :] = self.vectors[word]
+      if word in word2row:
+        vecs[index, :] = self.matrix[word2row[word]]
       else:
         # also tried np.random.uniform(low=-0.25, high=0.25, size=self.dimensions)
         vecs[index, :] = average
@@ -58,34 +290,72 @@ class Model:
       print('embedding oov rate: %s%%' % (round(oov_rate * 100, 2)))
     return vecs
 
-  def average_words(self, words):
+  def average_words(self, words, dtype=None):
     """Compute average vector for a list of words"""
 
-    words_found = 0 # words in vocabulary
-    sum = np.zeros(self.dimensions)
-    for word in words:
-      if word in self.vectors:
-        sum = sum + self.vectors[word]
-        words_found = words_found + 1
+    return self.average_documents([words], dtype)[0]
 
-    if words_found == 0:
-      return sum
-    else:
-      return sum / words_found
+  def average_documents(self, documents, dtype=None):
+    """Average vector of each document (list of words) as a matrix"""
+
+    dtype = self.dtype if dtype == None else dtype
+
+    # all words as rows in matrix (-1 if not in vocabulary)
+    word2row = vocab.as_dict(self.word2row)
+    rows = np.array(
+      [word2row.get(word, -1)
+       for document in documents for word in document], dtype=np.int64)
+    lengths = np.array([len(document) for document in documents], dtype=np.int64)
+    doc_index = np.repeat(np.arange(len(documents)), lengths)
+
+    known = rows >= 0
+    counts = np.bincount(doc_index[known], minlength=len(documents))
+
+    # sums as a sparse document by word count matrix times the
+    # vectors of distinct words; gathering a vector per token
+    # would need tokens x dimensions memory
+    used, columns = np.unique(rows[known], return_inverse=True)
+    word_counts = scipy.sparse.csr_matrix(
+      (np.ones(len(columns)), (doc_index[known], columns)),
+      shape=(len(documents), len(used)))
+
+    # documents without known words average to zeros
+    averages = np.zeros((len(documents), self.dimensions), dtype=dtype)
+    found = counts > 0
+    if found.any():
+      # sum in double precision even if vectors are float16
+      sums = word_counts.dot(np.asarray(self.matrix[used], dtype=np.float64))
+      averages[found] = sums[found] / counts[found, None]
+
+    return averages
 
   def words_to_vectors(self, infile, outfile):
-    """Convert texts from infile to vectors and save in outfile"""
+    """Convert texts from infile to vectors and save in outfile;
+    outfile ending in .npy is saved as a binary array"""
 
-    matrix = []
+    batches = []
     with open(infile) as file:
+      documents = []
       for line in file:
-        average = self.average_words(line.split())
-        matrix.append(list(average))
+        documents.append(line.split())
+        if len(documents) == DOCUMENT_BATCH:
+          batches.append(self.average_documents(documents))
+          documents = []
+      batches.append(self.average_documents(documents))
 
-    np.savetxt(outfile, np.array(matrix))
+    matrix = np.concatenate(batches)
+    if is_binary(outfile):
+      np.save(outfile, matrix)
+    else:
+      np.savetxt(outfile, matrix)
 
 if __name__ == "__main__":
 
+  if len(sys.argv) == 3:
+    # e.g. python3 word2vec.py vectors.txt vectors.npy
+    convert(sys.argv[1], sys.argv[2], verbose=True)
+    sys.exit()
+
   path = '/Users/Dima/Loyola/Data/Word2Vec/Models/GoogleNews-vectors-negative300.txt'
   model = Model(path)
 
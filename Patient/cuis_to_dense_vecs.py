@@ -4,8 +4,10 @@ from keras.models import load_model
 from keras.models import Model
 from keras.preprocessing.sequence import pad_sequences
 
-import configparser, os, pickle
+import configparser, os
 import sys
+sys.path.append('../Lib/')
+import vocab
 
 ''' Purpose: Taking a file that has CUIs per patient and loading a neural model
     that maps from CUIs to dense vectors, and writing out a vector per patient.
@@ -32,8 +34,7 @@ def main(args):
         outputs=model.get_layer('HL').output)
     
     alphabet_pickle = cfg.get('data', 'alphabet_pickle')
-    pkl = open(alphabet_pickle, 'rb')
-    token2int = pickle.load(pkl)
+    token2int = vocab.as_dict(vocab.load_alphabet(alphabet_pickle))
 
     for line in sys.stdin:
         line = line.rstrip()
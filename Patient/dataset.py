@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
-import numpy, pickle
+import numpy
 import configparser, os, nltk, pandas, sys
 sys.dont_write_bytecode = True
+sys.path.append('../Lib/')
+import vocab
 import glob, string, collections, operator
 
 # negation prefix e.g. nC0032326
@@ -20,7 +22,7 @@ class DatasetProvider:
     self.label2int = {'no':0, 'yes':1}
 
     if alphabet_pickle != None:
-      self.token2int = pickle.load(open(alphabet_pickle, 'rb'))
+      self.token2int = vocab.load_alphabet(alphabet_pickle)
 
   def get_cuis(self, file_name, ignore_negation=True):
     """Return file as a list of CUIs"""
@@ -43,6 +45,7 @@ class DatasetProvider:
 
     labels = []   # int labels
     examples = [] # int sequence represents each example
+    token2int = vocab.as_dict(self.token2int) # looked up per token
 
     for d in os.listdir(self.corpus_path):
       dir_path = os.path.join(self.corpus_path, d)
@@ -53,10 +56,10 @@ class DatasetProvider:
 
         example = []
         for token in set(file_feat_list):
-          if token in self.token2int:
-            example.append(self.token2int[token])
+          if token in token2int:
+            example.append(token2int[token])
           else:
-            example.append(self.token2int['oov_word'])
+            example.append(token2int['oov_word'])
 
         if len(example) > maxlen:
           example = example[0:maxlen]
@@ -26,7 +26,6 @@ from sklearn.metrics import recall_score
 from sklearn.model_selection import train_test_split
 import keras
 from keras.utils.np_utils import to_categorical
-from keras.preprocessing.sequence import pad_sequences
 from keras.models import Sequential
 from keras.layers.core import Dense, Activation, Dropout
 from keras.layers import GlobalAveragePooling1D
@@ -102,24 +101,23 @@ def main():
     cfg.getint('args', 'max_tokens_in_file'),
     cfg.getint('args', 'min_examples_per_code'),
     cfg.getboolean('args', 'collapse_codes'))
-  x, y = dataset.load()
-  train_x, val_x, train_y, val_y = train_test_split(
-    x,
-    y,
+  x, y = dataset.load(as_ragged=True)
+  train_idx, val_idx = train_test_split(
+    np.arange(len(x)),
     test_size=cfg.getfloat('args', 'test_size'))
-  maxlen = max([len(seq) for seq in train_x])
+  train_x, val_x = x[train_idx], x[val_idx]
+  y = np.array(y)
+  train_y, val_y = y[train_idx], y[val_idx]
+  maxlen = int(train_x.lengths().max())
 
   init_vectors = None
   if cfg.has_option('data', 'embed'):
     embed_file = os.path.join(base, cfg.get('data', 'embed'))
-    w2v = word2vec.Model(embed_file)
-    init_vectors = [w2v.select_vectors(dataset.token2int)]
+    init_vectors = [word2vec.load_vectors(embed_file, dataset.token2int)]
 
   # turn x into numpy array among other things
-  train_x = pad_sequences(train_x, maxlen=maxlen)
-  val_x = pad_sequences(val_x, maxlen=maxlen)
-  train_y = np.array(train_y)
-  val_y = np.array(val_y)
+  train_x = train_x.pad(maxlen)
+  val_x = val_x.pad(maxlen)
 
   print('train_x shape:', train_x.shape)
   print('train_y shape:', train_y.shape)
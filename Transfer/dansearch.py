@@ -26,7 +26,6 @@ from sklearn.metrics import recall_score
 from sklearn.model_selection import train_test_split
 import keras as k
 from keras.utils.np_utils import to_categorical
-from keras.preprocessing.sequence import pad_sequences
 from keras.models import Sequential
 from keras.layers.core import Dense, Activation, Dropout
 from keras.layers import GlobalAveragePooling1D
@@ -45,6 +44,7 @@ warnings.warn = warn
 
 RESULTS_FILE = 'Model/results.txt'
 MODEL_FILE = 'Model/model.h5'
+TRIALS_FILE = 'Model/trials.jsonl'
 
 def make_param_space():
   """Hyperparameter space"""
@@ -97,23 +97,23 @@ def main():
     cfg.getint('args', 'max_tokens_in_file'),
     cfg.getint('args', 'min_examples_per_code'),
     cfg.getboolean('args', 'collapse_codes'))
-  x, y = dataset.load()
-  x_train, x_val, y_train, y_val = train_test_split(
-    x, y, test_size=0.2)
-  max_len = max([len(seq) for seq in x_train])
+  x, y = dataset.load(as_ragged=True)
+  train_idx, val_idx = train_test_split(
+    np.arange(len(x)), test_size=0.2)
+  x_train, x_val = x[train_idx], x[val_idx]
+  y = np.array(y)
+  y_train, y_val = y[train_idx], y[val_idx]
+  max_len = int(x_train.lengths().max())
 
   # load pretrained embeddings
   init_vectors = None
   if cfg.has_option('data', 'embed'):
     embed_file = os.path.join(base, cfg.get('data', 'embed'))
-    w2v = word2vec.Model(embed_file)
-    init_vectors = [w2v.select_vectors(dataset.token2int)]
+    init_vectors = [word2vec.load_vectors(embed_file, dataset.token2int)]
 
   # turn x into numpy array among other things
-  x_train = pad_sequences(x_train, maxlen=max_len)
-  x_val = pad_sequences(x_val, maxlen=max_len)
-  y_train = np.array(y_train)
-  y_val = np.array(y_val)
+  x_train = x_train.pad(max_len)
+  x_val = x_val.pad(max_len)
 
   fixed_args = {
     'num_features': len(dataset.token2int),
@@ -123,6 +123,9 @@ def main():
   }
   param_space = make_param_space()
 
+  # processes, sampler, prune and budgets from [search]
+  options = rndsearch.options_from_config(cfg, param_space)
+
   results = rndsearch.run(
     make_model,
     fixed_args,
@@ -131,7 +134,9 @@ def main():
     y_train,
     x_val,
     y_val,
-    cfg.getint('search', 'n'))
+    cfg.getint('search', 'n'),
+    trials_file=TRIALS_FILE,
+    **options)
 
   # display configs sorted by f1
   print('\nconfigurations sorted by score:')
@@ -1,14 +1,10 @@
 #!/usr/bin/env python3
 
-import configparser, sys, os, shutil
+import configparser, sys, os, collections, numpy
 sys.dont_write_bytecode = True
 sys.path.append('../Codes')
-from dataset import DatasetProvider
+from dataset import DatasetProvider, CACHE_DIR
 
-MODEL_DIR = 'Model/'
-ALPHABET_FILE = 'Model/alphabet.txt'
-ALPHABET_PICKLE = 'Model/alphabet.p'
-CODE_FREQ_FILE = 'Model/codes.txt'
 DIAG_ICD9_FILE = 'DIAGNOSES_ICD.csv'
 
 class TransferDataset(DatasetProvider):
@@ -22,7 +18,9 @@ class TransferDataset(DatasetProvider):
                max_tokens_in_file,
                min_examples_per_code,
                collapse_codes,
-               use_cuis=True):
+               use_cuis=True,
+               cache_dir=CACHE_DIR,
+               processes=None):
     """Constructor. Allows to specify ICD codes."""
 
     self.corpus_path = corpus_path
@@ -33,32 +31,53 @@ class TransferDataset(DatasetProvider):
     self.min_examples_per_code = min_examples_per_code
     self.code_characters = 3 if collapse_codes else None
     self.use_cuis = use_cuis
+    self.cache_dir = cache_dir
+    self.processes = processes
 
     self.token2int = {}  # words indexed by frequency
-    self.subj2codes = {} # subj_id to set of icd9 codes
 
-    # remove old model directory and make a fresh one
-    if os.path.isdir(MODEL_DIR):
-      print('removing old model directory...')
-      shutil.rmtree(MODEL_DIR)
+    # subjects (rows) by codes (columns) binary csr matrix
+    self.code_pairs = []
+    self.subj2row = {}
+    self.code_names = []
+    self.subj_codes = None
+
+    # filled in by make_and_write_token_alphabet()
+    self.file2ids = collections.OrderedDict()
+    self.id2int = None
+
+    # artifacts are reused while their inputs don't change
+    code_file = os.path.join(self.code_dir, DIAG_ICD9_FILE)
+    self.artifact_dir = self.get_artifact_dir(
+      [code_file],
+      [min_token_freq, max_tokens_in_file, self.code_characters, use_cuis])
+
+    if self.load_artifacts():
+      print('reusing artifacts in', self.artifact_dir)
+      self.publish_artifacts()
+      return
+
     print('making alphabet and saving it in file...')
-    os.mkdir(MODEL_DIR)
     self.make_and_write_token_alphabet()
 
     # 3051 is actually tobacco use disorder
     # so don't need to truncate at 3 chars?
     print('mapping codes...')
-    code_file = os.path.join(self.code_dir, DIAG_ICD9_FILE)
     self.index_codes(
       code_file,
       'HADM_ID',
       'ICD9_CODE',
       'diag',
       self.code_characters)
+    self.make_subject_codes()
+
+    self.save_artifacts()
+    self.publish_artifacts()
 
   def load(self,
            maxlen=float('inf'),
-           tokens_as_set=True):
+           tokens_as_set=True,
+           as_ragged=False):
     """Make x and y"""
 
     labels = [] # does this example have one of predefined codes?
@@ -70,47 +89,27 @@ class TransferDataset(DatasetProvider):
       short_code = 'diag_%s' % line.strip()[0:self.code_characters]
       target_code_categories.add(short_code)
 
-    for file in os.listdir(self.corpus_path):
-      file_ngram_list = None
-      if self.use_cuis == True:
-        file_ngram_list = self.read_cuis(file)
-      else:
-        file_ngram_list = self.read_tokens(file)
-      if file_ngram_list == None:
-        continue # file too long
+    # columns of subj_codes that are target codes
+    target_cols = numpy.array(
+      [code in target_code_categories for code in self.code_names],
+      dtype=bool)
+
+    for file, ids in self.file2ids.items():
 
       # determine the label for this subj_id
       subj_id = file.split('.')[0]
-      if subj_id not in self.subj2codes:
+      if subj_id not in self.subj2row:
         continue # subject was present once with no code
-      if len(self.subj2codes[subj_id]) == 0:
-        continue # shouldn't happen
 
-      icd9_categories = set(self.subj2codes[subj_id])
-      overlap = target_code_categories.intersection(icd9_categories)
-      if len(overlap) > 0:
+      if target_cols[self.get_code_columns(subj_id)].any():
         labels.append(1) # this subj has a target code
       else:
         labels.append(0) # no target code for this subj
 
       # represent this example as a list of ints
-      example = []
-
-      if tokens_as_set:
-        file_ngram_list = set(file_ngram_list)
-
-      for token in file_ngram_list:
-        if token in self.token2int:
-          example.append(self.token2int[token])
-        else:
-          example.append(self.token2int['oov_word'])
-
-      if len(example) > maxlen:
-        example = example[0:maxlen]
-
-      examples.append(example)
+      examples.append(self.to_example(ids, maxlen, tokens_as_set))
 
-    return examples, labels
+    return self.to_examples(examples, as_ragged), labels
 
 if __name__ == "__main__":
 